@@ -0,0 +1,250 @@
+"""Benchmarks pawprint's endpoints against a stub Trac server (see
+stubtrac.py), driving the handlers through the WSGI application in
+csfam/pawprint/app.py with the App Engine SDK's service stubs, or through
+csfam/pawprint/wsgi.py's plain WSGI application with --wsgi.
+
+Run from the trac-rpc-lib folder with:
+
+    python -m bench.run --sdk ~/apps/google_appengine --tickets 10,1000,100000
+
+For every project size it reports each endpoint's latency percentiles,
+throughput and peak memory. Each endpoint runs in a forked process (where
+available) so peak memory isn't inflated by the endpoints before it.
+"""
+from StringIO import StringIO
+from optparse import OptionParser
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib
+import wsgiref.util
+
+from bench.stubtrac import PROJECT_START, CHANGE_INTERVAL
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (name, url, extra parameters, True if the endpoint is expensive enough
+# to only run for --heavy-iterations)
+ENDPOINTS = [
+    ('meta/getTypes', '/ticket/meta/getTypes', {}, False),
+    ('meta/getTypes refresh', '/ticket/meta/getTypes', {'refresh': '1'}, False),
+    ('milestone/getAll', '/milestone/getAll', {}, False),
+    ('batch meta', '/batch', {'ops': json.dumps([
+        {'op': 'ticket/meta/getTypes'}, {'op': 'ticket/meta/getStates'},
+        {'op': 'ticket/meta/getVersions'}, {'op': 'ticket/meta/getSeverities'},
+        {'op': 'ticket/meta/getResolutions'}, {'op': 'ticket/meta/getPriorities'},
+        {'op': 'milestone/getAll'}, {'op': 'component/getAll'}])}, False),
+    ('batch meta refresh', '/batch', {'refresh': '1', 'ops': json.dumps([
+        {'op': 'ticket/meta/getTypes'}, {'op': 'ticket/meta/getStates'},
+        {'op': 'ticket/meta/getVersions'}, {'op': 'ticket/meta/getSeverities'},
+        {'op': 'ticket/meta/getResolutions'}, {'op': 'ticket/meta/getPriorities'},
+        {'op': 'milestone/getAll'}, {'op': 'component/getAll'}])}, False),
+    ('ticket/getAll max=100', '/ticket/getAll', {'max': '100', 'page': '1'}, False),
+    ('ticket/getAll max=100 columnar', '/ticket/getAll',
+     {'max': '100', 'page': '1', 'format': 'columnar'}, False),
+    ('ticket/getAll all', '/ticket/getAll', {'max': '0'}, True),
+    ('ticket/sync recent', '/ticket/sync', {'since': None}, False),
+]
+
+
+def setup_appengine(sdk):
+    """Puts the SDK on the path and activates the service stubs"""
+    if sdk:
+        sys.path.insert(0, os.path.expanduser(sdk))
+    try:
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    except ImportError:
+        pass
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='trac-json-rpc-lib', overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    return bed
+
+
+def start_stub(tickets, latency):
+    """Starts stubtrac.py in its own process, returning the process
+    and the url of its project"""
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stubtrac.py'),
+                                '--tickets', str(tickets),
+                                '--latency', str(latency)],
+                               stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return process, "http://127.0.0.1:{0}/trac".format(port)
+
+
+def call(application, path, params):
+    """POSTs params to path on the WSGI application, returning the
+    response status and body"""
+    body = urllib.urlencode(params)
+    environ = {'REQUEST_METHOD': 'POST',
+               'PATH_INFO': path,
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': StringIO(body)}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    data = ''.join(application(environ, start_response))
+    return status[0], data
+
+
+def login(application, url):
+    status, data = call(application, '/login', {'url': url,
+                                                'username': 'bench',
+                                                'password': 'bench'})
+    response = json.loads(data)
+    if not response['success']:
+        raise Exception("login failed: {0}".format(response['reason']))
+    return response['token']
+
+
+def percentile(values, fraction):
+    """Gets the value at fraction (0-1) of the sorted values"""
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def measure(application, token, path, params, iterations):
+    """Calls an endpoint iterations times, returning its stats"""
+    params = dict(params)
+    params['token'] = token
+    gc.collect()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    errors = 0
+    size = 0
+    started = time.time()
+    for n in range(iterations):
+        before = time.time()
+        status, data = call(application, path, params)
+        latencies.append(time.time() - before)
+        size = len(data)
+        if not status.startswith('200') or not json.loads(data)['success']:
+            errors += 1
+    elapsed = time.time() - started
+    latencies.sort()
+    return {'iterations': iterations,
+            'errors': errors,
+            'bytes': size,
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p90': percentile(latencies, 0.9) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': latencies[-1] * 1000,
+            'throughput': iterations / elapsed,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'rss_growth': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss}
+
+
+def measure_isolated(application, token, path, params, iterations):
+    """Runs measure in a forked child so its peak memory is its own"""
+    if not hasattr(os, 'fork'):
+        return measure(application, token, path, params, iterations)
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            result = json.dumps(measure(application, token, path, params, iterations))
+        except Exception as e:
+            result = json.dumps({'failed': str(e)})
+        os.write(write_end, result)
+        os._exit(0)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+
+def report(tickets, latency, results):
+    print
+    print "{0} tickets, {1}ms upstream latency".format(tickets, latency)
+    print "{0:<32} {1:>5} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>10} {8:>10}".format(
+        'endpoint', 'err', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'req/s', 'peak KB', 'bytes')
+    for name, stats in results:
+        if 'failed' in stats:
+            print "{0:<32} failed: {1}".format(name, stats['failed'])
+            continue
+        print ("{0:<32} {1[errors]:>5} {1[p50]:>9.2f} {1[p90]:>9.2f} {1[p99]:>9.2f} "
+               "{1[max]:>9.2f} {1[throughput]:>9.1f} {1[peak_rss]:>10} {1[bytes]:>10}").format(name, stats)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--sdk', default=os.environ.get('GAE_SDK'),
+                      help="path to the App Engine SDK [$GAE_SDK]")
+    parser.add_option('--tickets', default='10,1000,100000',
+                      help="comma separated project sizes to run [%default]")
+    parser.add_option('--latency', type='float', default=20,
+                      help="stub server milliseconds per request [%default]")
+    parser.add_option('--iterations', type='int', default=50,
+                      help="calls made to each endpoint [%default]")
+    parser.add_option('--heavy-iterations', type='int', default=3,
+                      help="calls made to endpoints fetching every ticket [%default]")
+    parser.add_option('--endpoints', default=None,
+                      help="comma separated names of the endpoints to run [all]")
+    parser.add_option('--json', action='store_true', default=False,
+                      help="print the results as JSON instead of a table")
+    parser.add_option('--wsgi', action='store_true', default=False,
+                      help="run the plain WSGI application instead of App Engine's")
+    options, args = parser.parse_args(argv)
+
+    if options.wsgi:
+        from csfam.pawprint.wsgi import application
+    else:
+        setup_appengine(options.sdk)
+        from csfam.pawprint.app import application
+    from csfam.pawprint import traclib
+
+    endpoints = ENDPOINTS
+    if options.endpoints:
+        names = [name.strip() for name in options.endpoints.split(',')]
+        endpoints = [endpoint for endpoint in ENDPOINTS if endpoint[0] in names]
+
+    all_results = dict()
+    for tickets in [int(size) for size in options.tickets.split(',')]:
+        stub, url = start_stub(tickets, options.latency)
+        try:
+            token = login(application, url)
+            results = []
+            for name, path, params, heavy in endpoints:
+                if 'since' in params:
+                    # the last tenth of the project changed since the mark
+                    params = dict(params)
+                    params['since'] = time.strftime("%Y%m%dT%H:%M:%SZ", time.gmtime(
+                        PROJECT_START + (tickets - tickets // 10) * CHANGE_INTERVAL))
+                iterations = heavy and options.heavy_iterations or options.iterations
+                results.append((name, measure_isolated(application, token, path,
+                                                       params, iterations)))
+        finally:
+            stub.kill()
+            stub.wait()
+            # drop state tied to this stub's url before the next run
+            traclib.stored_proxies.clear()
+            traclib.metadata_cache.local.clear()
+        all_results[tickets] = results
+        if not options.json:
+            report(tickets, options.latency, results)
+
+    if options.json:
+        print json.dumps(dict((str(tickets), dict(results))
+                              for tickets, results in all_results.items()), indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,151 @@
+"""A stand-in Trac XML-RPC server serving a synthetic project, used by the
+benchmarks so pawprint can be measured without a real Trac.
+
+Run it on its own with:
+
+    python bench/stubtrac.py --tickets 1000 --latency 20
+
+It prints the port it's listening on and serves the project at
+http://127.0.0.1:<port>/trac until killed.
+"""
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from optparse import OptionParser
+import SocketServer
+import calendar
+import sys
+import time
+import xmlrpclib
+
+# the synthetic project's tickets change every CHANGE_INTERVAL seconds
+# starting at PROJECT_START
+PROJECT_START = 1293840000 # 2011-01-01T00:00:00Z
+CHANGE_INTERVAL = 60
+
+TYPES = ['defect', 'enhancement', 'task']
+STATUSES = ['new', 'assigned', 'accepted', 'reopened', 'closed']
+VERSIONS = ['1.0', '1.1', '2.0']
+SEVERITIES = ['blocker', 'critical', 'major', 'normal', 'minor', 'trivial']
+RESOLUTIONS = ['fixed', 'invalid', 'wontfix', 'duplicate', 'worksforme']
+PRIORITIES = ['highest', 'high', 'normal', 'low', 'lowest']
+MILESTONES = ['milestone1', 'milestone2', 'milestone3', 'milestone4']
+COMPONENTS = ['component1', 'component2', 'component3']
+OWNERS = ['alice', 'bob', 'carol', 'dave', 'erin']
+
+
+def changetime(ticket_id):
+    """Tickets with higher ids were changed more recently"""
+    return PROJECT_START + ticket_id * CHANGE_INTERVAL
+
+
+def to_datetime(timestamp):
+    return xmlrpclib.DateTime(time.gmtime(timestamp))
+
+
+class StubTrac(object):
+    """The XML-RPC methods of a Trac project with ticket ids 1 to tickets"""
+    def __init__(self, tickets, description_size=200):
+        self.tickets = tickets
+        self.description = 'x' * description_size
+
+    def get_api_version(self):
+        return [1, 1, 2]
+
+    def query(self, qstr='status!=closed'):
+        args = dict(arg.split('=', 1) for arg in qstr.split('&') if '=' in arg)
+        ids = range(1, self.tickets + 1)
+        limit = int(args.get('max', 100))
+        page = int(args.get('page', 1))
+        if limit > 0:
+            ids = ids[(page - 1) * limit:page * limit]
+        return ids
+
+    def get(self, ticket_id):
+        if ticket_id < 1 or ticket_id > self.tickets:
+            raise xmlrpclib.Fault(404, "Ticket {0} does not exist.".format(ticket_id))
+        created = to_datetime(PROJECT_START)
+        changed = to_datetime(changetime(ticket_id))
+        status = STATUSES[ticket_id % len(STATUSES)]
+        return [ticket_id, created, changed, {
+            'summary': "Synthetic ticket {0}".format(ticket_id),
+            'description': self.description,
+            'type': TYPES[ticket_id % len(TYPES)],
+            'status': status,
+            'resolution': status == 'closed' and RESOLUTIONS[ticket_id % len(RESOLUTIONS)] or '',
+            'priority': PRIORITIES[ticket_id % len(PRIORITIES)],
+            'severity': SEVERITIES[ticket_id % len(SEVERITIES)],
+            'milestone': MILESTONES[ticket_id % len(MILESTONES)],
+            'component': COMPONENTS[ticket_id % len(COMPONENTS)],
+            'version': VERSIONS[ticket_id % len(VERSIONS)],
+            'owner': OWNERS[ticket_id % len(OWNERS)],
+            'reporter': OWNERS[(ticket_id + 1) % len(OWNERS)],
+            'keywords': '',
+            'cc': '',
+            'time': created,
+            'changetime': changed}]
+
+    def get_recent_changes(self, since):
+        since = calendar.timegm(time.strptime(since.value, "%Y%m%dT%H:%M:%S"))
+        first = max(1, int((since - PROJECT_START + CHANGE_INTERVAL - 1) // CHANGE_INTERVAL))
+        return range(first, self.tickets + 1)
+
+    def register(self, server):
+        server.register_multicall_functions()
+        server.register_function(self.get_api_version, 'system.getAPIVersion')
+        server.register_function(self.query, 'ticket.query')
+        server.register_function(self.get, 'ticket.get')
+        server.register_function(self.get_recent_changes, 'ticket.getRecentChanges')
+        for name, values in [('type', TYPES), ('status', STATUSES),
+                             ('version', VERSIONS), ('severity', SEVERITIES),
+                             ('resolution', RESOLUTIONS), ('priority', PRIORITIES),
+                             ('milestone', MILESTONES), ('component', COMPONENTS)]:
+            server.register_function(lambda values=values: values,
+                                     'ticket.{0}.getAll'.format(name))
+
+
+class StubRequestHandler(SimpleXMLRPCRequestHandler):
+    """Serves keep-alive connections at Trac's RPC path, waiting for the
+    server's latency before answering each request"""
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ('/trac/login/rpc',)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class StubServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self, tickets, latency=0, port=0, description_size=200):
+        SimpleXMLRPCServer.__init__(self, ('127.0.0.1', port),
+                                    requestHandler=StubRequestHandler,
+                                    logRequests=False, allow_none=True)
+        self.latency = latency
+        StubTrac(tickets, description_size).register(self)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/trac".format(self.server_address[1])
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--tickets', type='int', default=1000,
+                      help="number of tickets in the project [%default]")
+    parser.add_option('--latency', type='float', default=0,
+                      help="milliseconds to wait before each response [%default]")
+    parser.add_option('--port', type='int', default=0,
+                      help="port to listen on, 0 picks a free one [%default]")
+    parser.add_option('--description-size', type='int', default=200,
+                      help="characters in each ticket description [%default]")
+    options, args = parser.parse_args(argv)
+
+    server = StubServer(options.tickets, options.latency / 1000.0,
+                        options.port, options.description_size)
+    print server.server_address[1]
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,24 +1,11 @@
-from csfam.pawprint.handlers import LoginService, GetAllTickets, GetTicketTypes,\
-    GetTicketStates, GetTicketVersions, GetTicketSeverities, GetTicketResolutions,\
-    GetTicketPriorities, GetMilestones, GetComponents
+from csfam.pawprint.routes import ROUTES
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-application = webapp.WSGIApplication([
-    ('/login', LoginService),
-    ('/ticket/getAll', GetAllTickets),
-    ('/ticket/meta/getTypes', GetTicketTypes),
-    ('/ticket/meta/getStates', GetTicketStates),
-    ('/ticket/meta/getVersions', GetTicketVersions),
-    ('/ticket/meta/getSeverities', GetTicketSeverities),
-    ('/ticket/meta/getResolutions', GetTicketResolutions),
-    ('/ticket/meta/getPriorities', GetTicketPriorities),
-    ('/milestone/getAll', GetMilestones),
-    ('/component/getAll', GetComponents)
-], debug=True)
+application = webapp.WSGIApplication(ROUTES, debug=True)
 
 def main():
     run_wsgi_app(application)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # outside App Engine TieredCache is only as good as its local cache
+    memcache = None
+
+
+def cache_key(*parts):
+    """Builds a fixed-length key out of the given parts so it can be
+    used for both the local caches and memcache (which limits key length)"""
+    encoded = []
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        encoded.append(str(part))
+    return hashlib.md5('\x00'.join(encoded)).hexdigest()
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded cache. Entries expire after ttl
+    seconds (or at an explicit expiry time) and the least recently
+    used entry is evicted once max_size entries are stored"""
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._map = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # circular doubly linked list of [prev, next, key, value, expires]
+        # links, the most recently used entry sits right after the root
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link == None:
+                self.misses += 1
+                return default
+            if link[4] != None and link[4] <= time.time():
+                self._unlink(link)
+                self.misses += 1
+                self.expirations += 1
+                return default
+            self._move_to_front(link)
+            self.hits += 1
+            return link[3]
+
+    def put(self, key, value, ttl=None, expires=None):
+        """Stores a value -- expires is an absolute time.time() value
+        and takes precedence over ttl, which falls back to the cache's ttl"""
+        if expires == None:
+            ttl = ttl or self.ttl
+            if ttl != None:
+                expires = time.time() + ttl
+        with self._lock:
+            link = self._map.get(key)
+            if link != None:
+                link[3] = value
+                link[4] = expires
+                self._move_to_front(link)
+                return
+            root = self._root
+            link = [root, root[1], key, value, expires]
+            root[1][0] = link
+            root[1] = link
+            self._map[key] = link
+            while len(self._map) > self.max_size:
+                self._unlink(root[0])
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            link = self._map.get(key)
+            if link == None:
+                return False
+            self._unlink(link)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def purge(self):
+        """Removes all expired entries, returning how many were removed"""
+        now = time.time()
+        with self._lock:
+            expired = [link for link in self._map.itervalues()
+                       if link[4] != None and link[4] <= now]
+            for link in expired:
+                self._unlink(link)
+            self.expirations += len(expired)
+            return len(expired)
+
+    def stats(self):
+        """Returns a dict of the cache's size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._map),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'hit_rate': lookups and float(self.hits) / lookups}
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _move_to_front(self, link):
+        root = self._root
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        del self._map[link[2]]
+
+
+class TieredCache(object):
+    """A process-local LRUCache in front of memcache. Reads check the local
+    cache first and fall through to memcache, writes and deletes go to both.
+    Values must be picklable so memcache can hold them. Without memcache
+    (outside App Engine) only the local cache is used"""
+    def __init__(self, namespace, max_size, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(max_size, ttl)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and memcache != None:
+            value = memcache.get(key, namespace=self.namespace)
+            if value is None:
+                self.memcache_misses += 1
+            else:
+                self.memcache_hits += 1
+                self.local.put(key, value)
+        return value
+
+    def put(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self.local.put(key, value, ttl=ttl)
+        if memcache != None:
+            memcache.set(key, value, time=ttl, namespace=self.namespace)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if memcache != None:
+            memcache.delete(key, namespace=self.namespace)
+
+    def stats(self):
+        """Returns the local cache's stats plus the memcache hit counters"""
+        stats = self.local.stats()
+        stats['memcache_hits'] = self.memcache_hits
+        stats['memcache_misses'] = self.memcache_misses
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = lookups and float(stats['hits'] + self.memcache_hits) / lookups
+        return stats
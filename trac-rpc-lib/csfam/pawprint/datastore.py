@@ -0,0 +1,202 @@
+from csfam.pawprint.store import SessionStore, login_key_name
+from datetime import datetime
+from google.appengine.ext import db
+import logging
+import time
+
+# whether sessions stored before they were keyed by token are looked for
+# (and migrated) when a login or token can't be found by key. Once every old
+# session has been migrated or expired (see migrate_legacy_sessions) this can
+# be turned off and the Session indexes in index.yaml removed
+MIGRATE_LEGACY_SESSIONS = True
+
+
+class Session(db.Model):
+    """Models a user's login session with the following fields:
+        - token
+        - username
+        - password
+        - trac_url
+        - expiry
+
+    Sessions are stored with their token as the key name
+    """
+    token = db.StringProperty(required=True)
+    trac_url = db.StringProperty(required=True)
+    username = db.StringProperty(required=True)
+    password = db.StringProperty(required=True)
+    expiry = db.DateTimeProperty(required=True)
+
+
+class SessionLogin(db.Model):
+    """Points a url/username/password combo at its live session so that
+    logins can reuse it, with the following fields:
+        - token
+        - expiry
+
+    SessionLogins are stored under a key name hashed from the credentials
+    (see login_key_name)
+    """
+    token = db.StringProperty(required=True)
+    expiry = db.DateTimeProperty(required=True)
+
+
+def session_group_key(url):
+    """Constructs a datastore key for a SessionGroup
+    entity with the given url. Sessions were stored under these
+    before they were keyed by token"""
+    return db.Key.from_path('SessionGroup', url)
+
+
+class DatastoreSessionStore(SessionStore):
+    """Keeps sessions in the App Engine datastore as Session entities
+    keyed by token, each pointed at by a SessionLogin"""
+    def new_session(self, token, url, username, password, expiry):
+        return Session(key_name=token,
+                       trac_url=url,
+                       username=username,
+                       password=password,
+                       token=token,
+                       expiry=expiry)
+
+    def login_session(self, url, username, password):
+        session = None
+        login = SessionLogin.get_by_key_name(login_key_name(url, username, password))
+        if login != None and login.expiry > datetime.now():
+            session = Session.get_by_key_name(login.token)
+        if session == None and MIGRATE_LEGACY_SESSIONS:
+            session = legacy_user_session(url, username, password)
+        return session
+
+    def session(self, token):
+        session = Session.get_by_key_name(token)
+        if session != None and session.expiry <= datetime.now():
+            session = None
+        if session == None and MIGRATE_LEGACY_SESSIONS:
+            session = legacy_session_for_token(token)
+        return session
+
+    def put(self, session):
+        login = SessionLogin(key_name=login_key_name(session.trac_url,
+                                                     session.username,
+                                                     session.password),
+                             token=session.token,
+                             expiry=session.expiry)
+        db.put([session, login])
+
+    def delete(self, session):
+        try:
+            session.delete()
+        except db.NotSavedError:
+            logging.error("tried removing a session that was not saved")
+        login = SessionLogin.get_by_key_name(login_key_name(session.trac_url,
+                                                            session.username,
+                                                            session.password))
+        if login != None and login.token == session.token:
+            login.delete()
+
+    def sweep(self, batch_size, time_limit):
+        started = time.time()
+        now = datetime.now()
+        report = {'sessions': 0, 'logins': 0, 'complete': True}
+        tokens = []
+        for kind, name in ((Session, 'sessions'), (SessionLogin, 'logins')):
+            query = kind.all(keys_only=True).filter('expiry <', now)
+            while True:
+                keys = query.fetch(batch_size)
+                if not keys:
+                    break
+                db.delete(keys)
+                report[name] += len(keys)
+                if kind == Session:
+                    # sessions are keyed by token (apart from unmigrated ones)
+                    tokens.extend([key.name() for key in keys if key.name() != None])
+                if len(keys) < batch_size:
+                    break
+                if time.time() - started > time_limit:
+                    report['complete'] = False
+                    break
+                query.with_cursor(query.cursor())
+        return (report, tokens)
+
+##
+## Migration of sessions stored before they were keyed by token
+##
+
+def legacy_user_session(url, username, password):
+    """Finds a live session for a user/url combo stored under its
+    SessionGroup, migrating it if found"""
+    session = Session.gql("WHERE ANCESTOR IS :key "
+                           "AND username = :user "
+                           "AND password = :pw "
+                           "AND expiry > :ex "
+                           "ORDER BY expiry DESC",
+                           key=session_group_key(url),
+                           user=username,
+                           pw=password,
+                           ex=datetime.now()).get()
+    if session == None:
+        return None
+    return migrate_session(session)
+
+
+def legacy_session_for_token(token):
+    """Finds a live session for a token stored under its SessionGroup,
+    migrating it if found"""
+    # this isn't an ancestor query so it's only eventually consistent,
+    # which is why sessions are now fetched by key instead
+    session = Session.gql("WHERE token = :t "
+                          "AND expiry > :ex",
+                          t=token,
+                          ex=datetime.now()).get()
+    if session == None:
+        return None
+    return migrate_session(session)
+
+
+def migrate_session(old):
+    """Stores a session found under its SessionGroup under its token key
+    name instead, along with its SessionLogin, and deletes the old entity.
+    Returns the migrated session"""
+    session = Session(key_name=old.token,
+                      trac_url=old.trac_url,
+                      username=old.username,
+                      password=old.password,
+                      token=old.token,
+                      expiry=old.expiry)
+    entities = [session]
+    login_name = login_key_name(old.trac_url, old.username, old.password)
+    login = SessionLogin.get_by_key_name(login_name)
+    # don't point the credentials at this session if they have a newer one
+    if login == None or login.expiry < old.expiry:
+        entities.append(SessionLogin(key_name=login_name,
+                                     token=old.token,
+                                     expiry=old.expiry))
+    db.put(entities)
+    old.delete()
+    logging.debug("migrated session %s", old.token)
+    return session
+
+
+def migrate_legacy_sessions(batch_size=100, cursor=None):
+    """Migrates up to batch_size sessions stored under a SessionGroup,
+    deleting those that have expired. Returns a tuple of the number of
+    sessions migrated or deleted and the cursor to pass for the next batch,
+    which is None once every session has been looked at"""
+    query = Session.all()
+    if cursor != None:
+        query.with_cursor(cursor)
+    sessions = query.fetch(batch_size)
+    count = 0
+    now = datetime.now()
+    for session in sessions:
+        if session.key().parent() == None:
+            continue
+        if session.expiry > now:
+            migrate_session(session)
+        else:
+            session.delete()
+        count += 1
+    if len(sessions) < batch_size:
+        return (count, None)
+    return (count, query.cursor())
@@ -0,0 +1,85 @@
+import copy
+import sys
+import threading
+import time
+
+
+class WaitTimeout(Exception):
+    """Raised when a caller gives up waiting for the call in flight"""
+
+
+class _Call(object):
+    """A call in flight and what its callers are waiting for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls made with the same key: the first caller
+    makes the call and everyone who asks for the same key while it's in
+    flight waits for it and gets a copy of its result (or its error)
+    instead of making the call again"""
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, function, timeout=None, share_error=None):
+        """Calls function, or waits for the call already in flight for key.
+        Waiters give up with a WaitTimeout after timeout seconds (if given).
+        share_error decides whether the error a call failed with is handed
+        to its waiters too, those it isn't given to try again instead"""
+        if timeout != None:
+            give_up = time.time() + timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call == None:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.calls += 1
+                    leader = True
+                else:
+                    call.waiters += 1
+                    self.shared += 1
+                    leader = False
+
+            if leader:
+                break
+            if timeout == None:
+                call.done.wait()
+            else:
+                call.done.wait(max(give_up - time.time(), 0))
+            if not call.done.is_set():
+                raise WaitTimeout()
+            if call.error == None:
+                # callers may change what they're given, so everyone gets a copy
+                return copy.deepcopy(call.result)
+            if share_error == None or share_error(call.error[1]):
+                raise call.error[0], call.error[1], call.error[2]
+
+        try:
+            call.result = function()
+        except:
+            # hand the error to the waiters so none of them hang
+            call.error = sys.exc_info()
+        with self._lock:
+            del self._calls[key]
+            shared = call.waiters > 0
+        call.done.set()
+
+        if call.error != None:
+            raise call.error[0], call.error[1], call.error[2]
+        elif shared:
+            return copy.deepcopy(call.result)
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'shared': self.shared,
+                    'in_flight': len(self._calls)}
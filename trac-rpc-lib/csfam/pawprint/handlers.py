@@ -1,13 +1,33 @@
 from csfam.pawprint.traclib import user_session, cleanup_session, \
-    MissingRequiredParameterError, Session, SessionExpiredError, proxy, TracError, \
+    MissingRequiredParameterError, SessionExpiredError, proxy, TracError, \
     trac_error_to_response, DoesNotSupportRPCError, protocol_error_to_trac_error, \
-    fault_error_to_trac_error, tickets_to_struct, generate_success_response
-from google.appengine.ext import webapp
+    fault_error_to_trac_error, tickets_to_struct, generate_success_response, \
+    run_batch, InvalidParameterError, session_for_token, fetch_tickets, \
+    iter_tickets_to_struct, write_success_response, sync_tickets, parse_fields, \
+    project_tickets, tickets_to_columns, write_columnar_response, \
+    sweep_expired_sessions, upstream_error_to_trac_error, \
+    metadata_entry, make_etag, etag_matches, TicketListTag, queue_warm_up, \
+    warm_session, ticket_page_query, take_ticket_page, WARM_AFTER_LOGIN, \
+    WARM_TICKET_PAGE_SIZE, ticket_index, ticket_page_after, decode_cursor, \
+    CURSOR_PAGE_SIZE
+from csfam.pawprint import stats
+from csfam.pawprint.transport import start_deadline, clear_deadline, \
+    CircuitOpen, DeadlineExceeded
 from xmlrpclib import ResponseError, ProtocolError, Fault
+import httplib
 import json
 import logging
-import xmlrpclib
-from datetime import datetime
+import math
+import socket
+
+try:
+    from google.appengine.ext import webapp
+except ImportError:
+    # outside App Engine the handlers run on pawprint's own WSGI framework
+    from csfam.pawprint import web as webapp
+
+# errors raised when the Trac server can't be reached in time
+UPSTREAM_ERRORS = (CircuitOpen, DeadlineExceeded, socket.error, httplib.HTTPException)
 
 
 class TracRequestHandler(webapp.RequestHandler):
@@ -25,6 +45,40 @@ class TracRequestHandler(webapp.RequestHandler):
         so they can deal with error that occur during the processing of the
         Trac request. We can't guarantee that session has a value."""
         pass
+
+    def flag(self, name):
+        """Returns True if the named request parameter is set to a
+        true-ish value ('1', 'true', 'yes')"""
+        return self.request.get(name).lower() in ('1', 'true', 'yes')
+
+    def int_param(self, name, default):
+        """Gets a request parameter that must be a whole number of zero
+        or more, or default if it wasn't given"""
+        value = self.request.get(name)
+        if not value:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            raise InvalidParameterError(name, value)
+        if number < 0:
+            raise InvalidParameterError(name, value)
+        return number
+
+    def start_deadline(self):
+        """Starts the deadline for the request's upstream calls. Clients
+        can shorten it with a 'timeout' parameter (in seconds), though not
+        below MIN_REQUEST_DEADLINE"""
+        timeout = self.request.get('timeout')
+        if not timeout:
+            return start_deadline()
+        try:
+            seconds = float(timeout)
+        except ValueError:
+            raise InvalidParameterError('timeout', timeout)
+        if seconds <= 0:
+            raise InvalidParameterError('timeout', timeout)
+        return start_deadline(seconds)
         
     def post(self):
         """Takes care of basic process of handling a TracRequest. Most subclasses of
@@ -32,30 +86,31 @@ class TracRequestHandler(webapp.RequestHandler):
         
         Trac requests must be accompanied by a 'token' parameter. This is used to
         map to a Session object which is required to make a request to the remote 
-        Trac server"""
+        Trac server. They may also pass a 'timeout' (see start_deadline)"""
         
+        timer = stats.start_request()
         try:
             session = None
+            self.start_deadline()
             token = self.request.get('token')
             
             if token == None:
                 raise MissingRequiredParameterError('token')
             
-            # TODO: need to explore the implications of the "eventually consistent"
-            # datastore on this query which is not an "ancestor query" 
-            session = Session.gql("WHERE token = :t "
-                                  "AND expiry > :ex", 
-                                  t=token,
-                                  ex=datetime.now()).get()
+            with stats.phase('session'):
+                session = session_for_token(token)
         
             if session == None:
                 raise SessionExpiredError(token)
             else:
                 # if we have a good session, call the handle function
                 # of the specific implementation of the TracRequestHandler
-                self.handle(proxy(session))
+                self.session = session
+                with stats.phase('proxy'):
+                    p = proxy(session)
+                self.handle(p)
         except TracError as te:
-            self.response.out.write(trac_error_to_response(te))
+            self.write_error(te)
             logging.exception("error handling Trac request: %s", str(te))
             self.caught_error(te, session)
         except ResponseError as re:
@@ -63,21 +118,71 @@ class TracRequestHandler(webapp.RequestHandler):
                 url = ""
             else:
                 url = session.trac_url
-            self.response.out.write(trac_error_to_response(DoesNotSupportRPCError(url)))
+            self.write_error(DoesNotSupportRPCError(url))
             logging.exception("error handling Trac request -- bad response: %s", str(re))
             self.caught_error(re, session)
         except ProtocolError as pe:
-            self.response.out.write(trac_error_to_response(protocol_error_to_trac_error(pe)))
+            self.write_error(protocol_error_to_trac_error(pe))
             logging.exception("error handling Trac request -- protocol error: %s", str(pe))
             self.caught_error(pe, session)
         except Fault as f:
-            self.response.out.write(trac_error_to_response(fault_error_to_trac_error(f)))
+            self.write_error(fault_error_to_trac_error(f))
             logging.exception("error handling Trac request -- fault: %s", str(f))
             self.caught_error(f, session)
+        except UPSTREAM_ERRORS as ue:
+            if session == None:
+                url = ""
+            else:
+                url = session.trac_url
+            self.write_error(upstream_error_to_trac_error(ue, url))
+            logging.warning("error handling Trac request -- unavailable: %s", str(ue))
+            self.caught_error(ue, session)
         except Exception as e:
-            self.response.out.write(trac_error_to_response(TracError(msg = "unknown error: {0}".format(str(e)))))
+            self.write_error(TracError(msg = "unknown error: {0}".format(str(e))))
             logging.exception("error handling Trac request: %s", str(e))
-            self.caught_error(e, session)    
+            self.caught_error(e, session)
+        finally:
+            self.finish_timing(timer)
+
+    def write_error(self, err):
+        """Writes a TracError out as the response, dropping anything a
+        handler already wrote out before failing. Tells clients when to
+        retry if the error says so"""
+        self.response.clear()
+        self.response.out.write(trac_error_to_response(err))
+        if getattr(err, 'retry_after', None) != None:
+            self.response.headers['Retry-After'] = str(int(math.ceil(err.retry_after)))
+        stats.record_error(err.code)
+
+    def write_result(self, result, etag=None):
+        """Writes a success response for result, or an empty 304 response
+        if the client already has it (see not_modified). The ETag is the
+        hash of the encoded response unless one is given, in which case
+        the result isn't even encoded if the client's copy matches"""
+        if etag != None and self.not_modified(etag):
+            return
+        body = generate_success_response(result)
+        if etag == None and self.not_modified(make_etag(body)):
+            return
+        self.response.out.write(body)
+
+    def not_modified(self, etag):
+        """Sets the response's ETag and, if it matches the request's
+        If-None-Match header, drops the response body and sets a 304 status.
+        Returns True if the response was turned into a 304"""
+        self.response.headers['ETag'] = etag
+        if not etag_matches(self.request.headers.get('If-None-Match'), etag):
+            return False
+        self.response.clear()
+        self.response.set_status(304)
+        return True
+
+    def finish_timing(self, timer):
+        """Reports the request's phase times in a Server-Timing header
+        and adds them to the endpoint's stats"""
+        clear_deadline()
+        self.response.headers['Server-Timing'] = timer.server_timing()
+        stats.finish_request(self.request.path, timer)
 
 
 class LoginService(TracRequestHandler):
@@ -89,6 +194,9 @@ class LoginService(TracRequestHandler):
         url: trac url (http://server/trac)
         username: username string
         password: password string
+        warm: if true, fetch the metadata lists and first page of tickets
+              into the caches in the background (see WarmSession)
+        max: number of tickets on the first page to warm (see GetAllTickets)
     
     returns json objects (as strings):
     success:
@@ -104,8 +212,10 @@ class LoginService(TracRequestHandler):
         }
     """
     def post(self):
+        timer = stats.start_request()
         try:
             session = None
+            self.start_deadline()
             url = self.request.get('url');
             username = self.request.get('username')
             password = self.request.get('password')
@@ -116,119 +226,407 @@ class LoginService(TracRequestHandler):
             elif password == None:
                 raise MissingRequiredParameterError('password')            
     
+            warm = WARM_AFTER_LOGIN and self.flag('warm')
+            if warm:
+                page_size = self.int_param('max', WARM_TICKET_PAGE_SIZE)
+    
             session = user_session(url, username, password)
+            if warm:
+                queue_warm_up(session, page_size)
             self.response.out.write(json.dumps({'success': True, 'token': session.token}))
         except TracError as te:
-            self.response.out.write(trac_error_to_response(te))
+            self.write_error(te)
             logging.exception("error handling Trac request: %s", str(te))
             self.caught_error(te, session)
         except ResponseError as re:
-            self.response.out.write(trac_error_to_response(DoesNotSupportRPCError(url)))
+            self.write_error(DoesNotSupportRPCError(url))
             logging.exception("error handling Trac request -- bad response: %s", str(re))
             self.caught_error(re, session)
         except ProtocolError as pe:
-            self.response.out.write(trac_error_to_response(protocol_error_to_trac_error(pe)))
+            self.write_error(protocol_error_to_trac_error(pe))
             logging.exception("error handling Trac request -- protocol error: %s", str(pe))
             self.caught_error(pe, session)
         except Fault as f:
-            self.response.out.write(trac_error_to_response(fault_error_to_trac_error(f)))
+            self.write_error(fault_error_to_trac_error(f))
             logging.exception("error handling Trac request -- fault: %s", str(f))
             self.caught_error(f, session)
+        except UPSTREAM_ERRORS as ue:
+            self.write_error(upstream_error_to_trac_error(ue, url))
+            logging.warning("error handling Trac request -- unavailable: %s", str(ue))
+            self.caught_error(ue, session)
         except Exception as e:
-            self.response.out.write(trac_error_to_response(TracError(msg = "unknown error: {0}".format(str(e)))))
+            self.write_error(TracError(msg = "unknown error: {0}".format(str(e))))
             logging.exception("error handling Trac request: %s", str(e))
             self.caught_error(e, session)
+        finally:
+            self.finish_timing(timer)
 
     def caught_error(self, err, session):
         if session != None:
             cleanup_session(session)
 
 
-class GetTicketTypes(TracRequestHandler):
+class MetadataRequestHandler(TracRequestHandler):
+    """Base class for requests returning one of a Trac's metadata lists.
+    Results are cached per Trac url since they are the same for every
+    user and rarely change. Responses carry an ETag cached with the list,
+    so clients sending it back in If-None-Match get an empty 304 response
+    if the list hasn't changed
+    
+    Parameters:
+      refresh - if true, bypass the cache and fetch the list from Trac
+    """
+    method = None
+    
+    def handle(self, proxy):
+        result, etag = metadata_entry(self.session, proxy, self.method, self.flag('refresh'))
+        self.write_result(result, etag)
+
+
+class GetTicketTypes(MetadataRequestHandler):
     """Gets a list of the different types of tickets the Trac 
     system can have
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.type.getAll()))
+    method = 'ticket.type.getAll'
 
 
-class GetTicketStates(TracRequestHandler):
+class GetTicketStates(MetadataRequestHandler):
     """Gets a list of the different states that a ticket can
     have in this Trac system
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.status.getAll()))
+    method = 'ticket.status.getAll'
 
 
-class GetTicketVersions(TracRequestHandler):
+class GetTicketVersions(MetadataRequestHandler):
     """Gets a list of all the ticket version names that a
     ticket can have in this Trac system 
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.version.getAll()))
+    method = 'ticket.version.getAll'
 
 
-class GetTicketSeverities(TracRequestHandler):
+class GetTicketSeverities(MetadataRequestHandler):
     """Gets a list of all ticket serverity names that a 
     ticket can have in this Trac system
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.severity.getAll()))
+    method = 'ticket.severity.getAll'
 
 
-class GetTicketResolutions(TracRequestHandler):
+class GetTicketResolutions(MetadataRequestHandler):
     """Gets a list of all ticket resolution names that a 
     ticket can have in this Trac system
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.resolution.getAll()))
+    method = 'ticket.resolution.getAll'
 
 
-class GetTicketPriorities(TracRequestHandler):
+class GetTicketPriorities(MetadataRequestHandler):
     """Gets a list of all ticket priority names that a 
     ticket can have in this Trac system
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.priority.getAll()))
+    method = 'ticket.priority.getAll'
 
 
-class GetMilestones(TracRequestHandler):
+class GetMilestones(MetadataRequestHandler):
     """Gets a list of all milestone names in this Trac system
     """    
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.milestone.getAll()))
+    method = 'ticket.milestone.getAll'
 
 
-class GetComponents(TracRequestHandler):
+class GetComponents(MetadataRequestHandler):
     """Gets a list of all component names
     """
-    def handle(self, proxy):
-        self.response.out.write(generate_success_response(proxy.ticket.component.getAll()))
+    method = 'ticket.component.getAll'
+
+
+class TicketListRequestHandler(TracRequestHandler):
+    """Base class for requests returning a list of tickets, letting
+    clients trim down what gets sent back. Responses carry an ETag, clients
+    sending it back in If-None-Match get an empty 304 response if none of
+    the tickets changed
+    
+    Parameters:
+      fields - comma separated list of the ticket fields to return, the
+               id field is always returned
+      format - 'columnar' to return the field names once followed by
+               each ticket as a list of values:
+                 { "fields": ["id", "status"], "rows": [[1, "new"], ...] }
+               otherwise each ticket is returned as an object
+    """
+    def ticket_format(self):
+        format = self.request.get('format') or 'objects'
+        if format not in ('objects', 'columnar'):
+            raise InvalidParameterError('format', format)
+        return format
+    
+    def write_tickets(self, tickets):
+        """Writes a success response for the ticket structs in the requested
+        fields and format, encoding tickets as they're read from the iterable"""
+        format = self.ticket_format()
+        fields = parse_fields(self.request.get('fields'))
+        if format == 'columnar':
+            fields, rows = tickets_to_columns(tickets, fields)
+            write_columnar_response(self.response.out, fields, rows)
+        else:
+            if fields != None:
+                tickets = project_tickets(tickets, fields)
+            write_success_response(self.response.out, tickets)
+    
+    def format_tickets(self, tickets):
+        """Returns a structure holding the ticket structs in the requested
+        fields and format"""
+        format = self.ticket_format()
+        fields = parse_fields(self.request.get('fields'))
+        if format == 'columnar':
+            fields, rows = tickets_to_columns(tickets, fields)
+            return {'fields': fields, 'rows': list(rows)}
+        elif fields != None:
+            return list(project_tickets(tickets, fields))
+        return tickets
 
 
-class GetAllTickets(TracRequestHandler):
+class GetAllTickets(TicketListRequestHandler):
     """Request all tickets for this Trac -- can request a max number
     of tickets (per page) and specify a page number for paged results
     
+    The first request for a page warmed after login is served from the
+    cache (see LoginService)
+    
     Parameters:
       max - a number representing the max number of results to get
       page - a number specifying which page to grab
+      cursor - pass this (empty for the first page) instead of page to get
+               pages that don't shift when tickets are added or deleted.
+               Each page is returned along with the cursor to pass for the
+               next one, which is null on the last page:
+                 { "tickets": [ <ticket>, ... ], "cursor": "eyJxIjo..." }
+      fields, format - see TicketListRequestHandler
+      refresh - if true, fetch the tickets from Trac even if they were warmed
     """
     def handle(self, proxy):
+        if 'cursor' in self.request.arguments():
+            self.handle_cursor(proxy)
+            return
+        
         # if no max given, then use zero to set no limit
         m = self.request.get('max') or 0 
         # if no page given, then use 1 as page
         p = self.request.get('page') or 1
-        query = 'max={m}&page={p}'.format(m=m, p=p)
-        ticketIds = proxy.ticket.query(query)
-        multicall = xmlrpclib.MultiCall(proxy)
+        query = ticket_page_query(m, p)
+        tickets = None
+        if not self.flag('refresh'):
+            tickets = take_ticket_page(self.session, query)
+        if tickets == None:
+            ticketIds = proxy.ticket.query(query)
+            # tickets are fetched in chunked MultiCalls run in parallel, then
+            # converted and written out one at a time as they arrive
+            tickets = iter_tickets_to_struct(fetch_tickets(proxy, ticketIds))
+        # the ETag is built from the ticket ids and the latest changetime
+        # while the tickets are written out
+        tag = TicketListTag(self.request.get('fields'), self.ticket_format())
+        self.write_tickets(tag.track(tickets))
+        self.not_modified(tag.etag())
+    
+    def handle_cursor(self, proxy):
+        cursor = self.request.get('cursor')
+        if cursor:
+            query, after, page_size = decode_cursor(cursor)
+        else:
+            query, after, page_size = '', 0, CURSOR_PAGE_SIZE
+        page_size = self.int_param('max', page_size)
+        ticketIds, cursor = ticket_page_after(self.session, proxy, query, after, page_size)
+        tickets = tickets_to_struct(fetch_tickets(proxy, ticketIds))
+        self.write_result({'tickets': self.format_tickets(tickets), 'cursor': cursor})
+
 
-        for ticketId in ticketIds:
-            multicall.ticket.get(ticketId)
+class SyncTickets(TicketListRequestHandler):
+    """Gets only the tickets that changed since the last sync, so
+    clients can stay current without re-fetching every ticket
+    
+    Parameters:
+      since - the high-water mark returned by the previous sync, or any
+              ticket changetime (e.g. "20110131T18:30:00Z")
+      fields, format - see TicketListRequestHandler
+    
+    returns the changed tickets and the mark to pass as since next time:
+        { "success": true,
+          "result": { "tickets": [ <ticket>, ... ],
+                      "since": "20110131T18:42:10Z" }
+        }
+    """
+    def handle(self, proxy):
+        since = self.request.get('since')
+        if not since:
+            raise MissingRequiredParameterError('since')
+        tickets, mark = sync_tickets(proxy, since)
+        self.write_result({'tickets': self.format_tickets(tickets), 'since': mark})
+
+
+class FindTickets(TicketListRequestHandler):
+    """Filters and sorts the tickets of this Trac using an index of them
+    kept in memory (see traclib.ticket_index), so common list views don't
+    need every ticket fetched from Trac. The index is synced with the
+    tickets changed in Trac every TICKET_INDEX_SYNC_INTERVAL seconds
+    
+    Parameters:
+      filter - JSON object of ticket fields to the value, or list of values,
+               they must have, e.g. {"status": ["new", "assigned"], "owner": "bob"}
+      sort - the field to sort the tickets on (then by id), prefixed with
+             '-' to sort in descending order, e.g. "-changetime"
+      offset - number of matching tickets to skip
+      limit - max number of tickets to return, 0 for no limit
+      refresh - if true, sync the index with Trac first
+      fields, format - see TicketListRequestHandler
+    """
+    def handle(self, proxy):
+        filters = self.filters()
+        sort = self.request.get('sort') or 'id'
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        offset = self.int_param('offset', 0)
+        limit = self.int_param('limit', 0)
         
-        tickets = multicall()
+        index = ticket_index(self.session, proxy, self.flag('refresh'))
+        tickets = index.find(filters, sort, descending, offset, limit)
+        tag = TicketListTag(self.request.get('fields'), self.ticket_format())
+        self.write_tickets(tag.track(tickets))
+        self.not_modified(tag.etag())
+    
+    def filters(self):
+        """Parses the filter parameter into a dict of field names to
+        lists of accepted values"""
+        value = self.request.get('filter')
+        if not value:
+            return None
+        try:
+            filters = json.loads(value)
+        except ValueError:
+            raise InvalidParameterError('filter', value)
+        if not isinstance(filters, dict):
+            raise InvalidParameterError('filter', value)
+        for field, accepted in filters.items():
+            if not isinstance(accepted, list):
+                accepted = [accepted]
+                filters[field] = accepted
+            for v in accepted:
+                if isinstance(v, (list, dict)):
+                    raise InvalidParameterError('filter', value)
+        return filters
+
+
+class Batch(TracRequestHandler):
+    """Runs several operations in a single request, making one
+    MultiCall to the Trac server for all of them
+    
+    Parameters:
+      ops - JSON list of operations, each an object naming the operation
+            plus its parameters:
+              {"op": "ticket/meta/getTypes"} (or any other metadata list url,
+                                              e.g. "milestone/getAll")
+              {"op": "ticket/query", "query": "status!=closed"}
+              {"op": "ticket/get", "id": 42}
+      refresh - if true, fetch metadata lists from Trac instead of the cache
+    
+    returns a list holding a response for each operation, in order:
+        { "success": true,
+          "result": [ { "success": true, "result": ["defect", "task"] },
+                      { "success": false,
+                        "reason": { "errcode": 358, "errmsg": "..." } } ]
+        }
+    """
+    def handle(self, proxy):
+        ops = self.request.get('ops')
+        if not ops:
+            raise MissingRequiredParameterError('ops')
+        try:
+            ops = json.loads(ops)
+        except ValueError:
+            raise InvalidParameterError('ops', ops)
+        if not isinstance(ops, list):
+            raise InvalidParameterError('ops', ops)
         
-        if tickets == None:
-            self.response.out.write('[]')
-        else:
-            self.response.out.write(generate_success_response(tickets_to_struct(tickets)))
\ No newline at end of file
+        results = run_batch(self.session, proxy, ops, self.flag('refresh'))
+        self.write_result(results)
+
+
+class WarmSession(webapp.RequestHandler):
+    """Task queued by LoginService fetching a new session's metadata lists
+    and first page of tickets into the caches, so the client's first
+    requests after logging in don't each wait on Trac
+    
+    Parameters:
+      token - the new session's token
+      max - number of tickets on the first page
+    """
+    def post(self):
+        session = session_for_token(self.request.get('token'))
+        if session == None:
+            logging.info("not warming an expired session")
+            return
+        page_size = int(self.request.get('max') or WARM_TICKET_PAGE_SIZE)
+        start_deadline()
+        try:
+            warmed = warm_session(session, proxy(session), page_size)
+        except (TracError, ResponseError, ProtocolError, Fault) + UPSTREAM_ERRORS as e:
+            # retrying wouldn't finish before the client's first requests
+            logging.warning("could not warm session for %s: %s", session.trac_url, str(e))
+            return
+        except Exception:
+            # nor would it fix a bug, so don't let the task queue retry it either
+            logging.exception("could not warm session for %s", session.trac_url)
+            return
+        finally:
+            clear_deadline()
+        logging.debug("warmed metadata and %d tickets for %s", warmed, session.trac_url)
+
+
+class StatsService(webapp.RequestHandler):
+    """Reports this instance's per-endpoint latency histograms and phase
+    times, error counts by TracError code and cache hit rates. Stats are
+    kept in memory, so each instance reports only what it has handled.
+    Only admins can get to it (see app.yaml)
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(generate_success_response(stats.report()))
+
+
+class MigrateSessions(webapp.RequestHandler):
+    """Admin task migrating datastore sessions stored before sessions were
+    keyed by token. Each request looks at up to ten batches of sessions, keep
+    calling it with the returned cursor until the cursor is null
+    
+    Parameters:
+      cursor - the cursor returned by the previous request, if any
+    
+    returns:
+        { "success": true,
+          "result": { "migrated": 42, "cursor": "E9oBDGo..." }
+        }
+    """
+    def get(self):
+        # only imported when needed since it depends on the datastore
+        from csfam.pawprint.datastore import migrate_legacy_sessions
+        cursor = self.request.get('cursor') or None
+        migrated = 0
+        for n in range(10):
+            count, cursor = migrate_legacy_sessions(cursor=cursor)
+            migrated += count
+            if cursor == None:
+                break
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(generate_success_response({'migrated': migrated,
+                                                           'cursor': cursor}))
+
+
+class SweepSessions(webapp.RequestHandler):
+    """Cron task deleting expired sessions from the session store and
+    their proxies from this instance (see cron.yaml)
+    
+    returns:
+        { "success": true,
+          "result": { "sessions": 120, "logins": 118, "proxies": 3,
+                      "seconds": 1.52, "complete": true }
+        }
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(generate_success_response(sweep_expired_sessions()))
\ No newline at end of file
@@ -0,0 +1,106 @@
+import threading
+
+
+def later_changetime(mark, ticket):
+    """Gets the later of mark and the ticket struct's changetime (see
+    tickets_to_struct), which are fixed width so compare fine as strings"""
+    if ticket['changetime'] > mark:
+        return ticket['changetime']
+    return mark
+
+
+class TicketIndex(object):
+    """The ticket structs (see tickets_to_struct) of a Trac project held in
+    memory, with an inverted index on each of the given fields so lists
+    filtered on them can be answered without asking Trac.
+
+    The index doesn't talk to Trac itself, whoever fills it should hold
+    lock while they refresh it (see traclib.ticket_index)"""
+    def __init__(self, fields):
+        self.fields = fields
+        self.lock = threading.RLock()
+        # time.time() of the last full build and of the last sync
+        self.built = None
+        self.synced = None
+        # (time.time(), ticket count) of the last build refused for having
+        # too many tickets, or None
+        self.refused = None
+        self._reset()
+
+    def _reset(self):
+        self.tickets = dict()
+        # field -> value -> set of the ids of the tickets with that value
+        self.values = dict((field, dict()) for field in self.fields)
+        # the changetime to sync from: the latest one of the indexed tickets,
+        # which whoever fills the index may move back (see traclib.sync_tickets)
+        self.mark = ''
+
+    def replace(self, tickets):
+        """Replaces every ticket in the index with the given ones"""
+        with self.lock:
+            self._reset()
+            self.update(tickets)
+
+    def update(self, tickets):
+        """Adds the given tickets to the index, replacing any older
+        versions of them"""
+        with self.lock:
+            for ticket in tickets:
+                old = self.tickets.get(ticket['id'])
+                if old != None:
+                    self._unindex(old)
+                self.tickets[ticket['id']] = ticket
+                for field in self.fields:
+                    ids = self.values[field].setdefault(ticket.get(field), set())
+                    ids.add(ticket['id'])
+                self.mark = later_changetime(self.mark, ticket)
+
+    def _unindex(self, ticket):
+        for field in self.fields:
+            ids = self.values[field].get(ticket.get(field))
+            if ids != None:
+                ids.discard(ticket['id'])
+                if not ids:
+                    del self.values[field][ticket.get(field)]
+
+    def find(self, filters=None, sort='id', descending=False, offset=0, limit=0):
+        """Gets a list of the tickets matching filters, a dict of field names
+        to lists of accepted values, sorted on the sort field (then by id)
+        and sliced by offset and limit (0 for no limit)"""
+        with self.lock:
+            ids = None
+            unindexed = []
+            for field, accepted in (filters or {}).items():
+                if self.values.has_key(field):
+                    matched = set()
+                    for value in accepted:
+                        matched.update(self.values[field].get(value, ()))
+                    if ids == None:
+                        ids = matched
+                    else:
+                        ids &= matched
+                else:
+                    unindexed.append((field, set(accepted)))
+
+            if ids == None:
+                candidates = self.tickets.values()
+            else:
+                candidates = [self.tickets[ticket_id] for ticket_id in ids]
+
+        tickets = [ticket for ticket in candidates
+                   if all(ticket.get(field) in accepted for field, accepted in unindexed)]
+        tickets.sort(key=lambda ticket: (ticket.get(sort), ticket['id']), reverse=descending)
+        if limit:
+            return tickets[offset:offset + limit]
+        return tickets[offset:]
+
+    def stats(self):
+        with self.lock:
+            return {'tickets': len(self.tickets),
+                    'mark': self.mark,
+                    'built': self.built,
+                    'synced': self.synced,
+                    'refused': self.refused}
+
+    def __len__(self):
+        return len(self.tickets)
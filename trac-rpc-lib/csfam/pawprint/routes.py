@@ -0,0 +1,30 @@
+from csfam.pawprint.handlers import LoginService, GetAllTickets, GetTicketTypes,\
+    GetTicketStates, GetTicketVersions, GetTicketSeverities, GetTicketResolutions,\
+    GetTicketPriorities, GetMilestones, GetComponents, Batch, SyncTickets, \
+    StatsService, MigrateSessions, SweepSessions, WarmSession, FindTickets
+
+# url patterns mapped to their handlers, served by app.py on App Engine
+# and by wsgi.py elsewhere
+ROUTES = [
+    ('/login', LoginService),
+    ('/ticket/getAll', GetAllTickets),
+    ('/ticket/sync', SyncTickets),
+    ('/ticket/find', FindTickets),
+    ('/ticket/meta/getTypes', GetTicketTypes),
+    ('/ticket/meta/getStates', GetTicketStates),
+    ('/ticket/meta/getVersions', GetTicketVersions),
+    ('/ticket/meta/getSeverities', GetTicketSeverities),
+    ('/ticket/meta/getResolutions', GetTicketResolutions),
+    ('/ticket/meta/getPriorities', GetTicketPriorities),
+    ('/milestone/getAll', GetMilestones),
+    ('/component/getAll', GetComponents),
+    ('/batch', Batch),
+    ('/stats', StatsService),
+    ('/tasks/migrateSessions', MigrateSessions),
+    ('/tasks/sweepSessions', SweepSessions),
+    ('/tasks/warmSession', WarmSession)
+]
+
+# url patterns only admins may use -- these must match the urls with
+# "login: admin" in app.yaml
+ADMIN_URLS = ('/stats', '/tasks/.*')
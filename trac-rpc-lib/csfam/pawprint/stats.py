@@ -0,0 +1,155 @@
+import threading
+import time
+
+# upper bounds (in milliseconds) of the request latency histogram buckets,
+# requests slower than the last bound are counted in an overflow bucket
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# the timer of the request being handled by the current thread
+current = threading.local()
+
+# EndpointStats keyed by request path
+endpoints = dict()
+
+# number of errors returned to clients keyed by TracError code
+errors = dict()
+
+# functions returning the stats of caches, connection pools, etc. keyed
+# by the name they're reported under
+sources = dict()
+
+lock = threading.Lock()
+
+
+class RequestTimer(object):
+    """Adds up the time a request spends in each phase of handling it
+    (session lookup, upstream calls, encoding, ...)"""
+    def __init__(self):
+        self.started = time.time()
+        self.phases = dict()
+        self.order = []
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            if not self.phases.has_key(phase):
+                self.phases[phase] = 0.0
+                self.order.append(phase)
+            self.phases[phase] += seconds
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def server_timing(self):
+        """Formats the phase times as a Server-Timing header value. Phases
+        that run in parallel (upstream calls) are summed, so they may
+        add up to more than the total"""
+        with self._lock:
+            timings = ["{0};dur={1:.1f}".format(phase, self.phases[phase] * 1000)
+                       for phase in self.order]
+        timings.append("total;dur={0:.1f}".format(self.elapsed() * 1000))
+        return ", ".join(timings)
+
+
+class phase(object):
+    """Context manager adding the time spent in its block to a phase of
+    the current request's timer"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        add_phase(self.name, time.time() - self.started)
+        return False
+
+
+class EndpointStats(object):
+    """Aggregated request latencies and phase times for one endpoint"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.phases = dict()
+
+    def record(self, timer):
+        elapsed = timer.elapsed()
+        self.count += 1
+        self.total += elapsed
+        ms = elapsed * 1000
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                self.buckets[n] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        for name, seconds in timer.phases.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def to_struct(self):
+        # [upper bound in ms, count] pairs, the overflow bucket's bound is None
+        histogram = [[bound, self.buckets[n]] for n, bound in enumerate(LATENCY_BUCKETS)]
+        histogram.append([None, self.buckets[-1]])
+        return {'count': self.count,
+                'mean_ms': self.count and self.total * 1000 / self.count,
+                'histogram': histogram,
+                'phase_mean_ms': dict((name, seconds * 1000 / self.count)
+                                      for name, seconds in self.phases.items())}
+
+
+def start_request():
+    """Starts timing a request handled by the current thread"""
+    current.timer = RequestTimer()
+    return current.timer
+
+
+def finish_request(endpoint, timer):
+    """Adds a finished request's times to its endpoint's stats"""
+    current.timer = None
+    with lock:
+        stats = endpoints.get(endpoint)
+        if stats == None:
+            stats = EndpointStats()
+            endpoints[endpoint] = stats
+        stats.record(timer)
+
+
+def current_timer():
+    return getattr(current, 'timer', None)
+
+
+def set_current_timer(timer):
+    """Lets worker threads add their time to the request they work for"""
+    current.timer = timer
+
+
+def add_phase(name, seconds):
+    """Adds time to a phase of the current request, if one is being timed"""
+    timer = current_timer()
+    if timer != None:
+        timer.add(name, seconds)
+
+
+def record_error(code):
+    """Counts an error returned to a client by its TracError code"""
+    with lock:
+        errors[code] = errors.get(code, 0) + 1
+
+
+def register(name, stats_function):
+    """Adds the stats returned by a function (e.g. a cache's stats
+    method) to the stats report"""
+    sources[name] = stats_function
+
+
+def report():
+    """Gets all of this instance's stats as a JSON-able structure"""
+    with lock:
+        report = {'endpoints': dict((endpoint, stats.to_struct())
+                                    for endpoint, stats in endpoints.items()),
+                  'errors': dict((str(code), count) for code, count in errors.items())}
+    report['sources'] = dict((name, stats_function())
+                             for name, stats_function in sources.items())
+    return report
@@ -0,0 +1,262 @@
+from datetime import datetime
+import hashlib
+import os
+import threading
+import time
+
+# where sessions are kept: 'datastore' (App Engine only), 'memory' (lost on
+# restart and not shared between processes) or 'sqlite:<path>' (shared by
+# every process on a host). Defaults to the datastore on App Engine and to
+# memory elsewhere, the PAWPRINT_SESSION_STORE environment variable overrides it
+SESSION_STORE = os.environ.get('PAWPRINT_SESSION_STORE')
+
+# seconds a SQLite connection waits on another process's write lock
+SQLITE_TIMEOUT = 10
+
+# the SessionStore in use, opened from SESSION_STORE on first use
+current = None
+current_lock = threading.Lock()
+
+
+def login_key_name(url, username, password):
+    """Hashes a url/username/password combo into the key its live
+    session's token is stored under"""
+    parts = []
+    for part in (url, username, password):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        parts.append(part)
+    return hashlib.sha256('\x00'.join(parts)).hexdigest()
+
+
+def default_store():
+    try:
+        from google.appengine.ext import db
+        return 'datastore'
+    except ImportError:
+        return 'memory'
+
+
+def open_store(spec):
+    """Opens the SessionStore described by spec (see SESSION_STORE)"""
+    if spec == 'datastore':
+        from csfam.pawprint.datastore import DatastoreSessionStore
+        return DatastoreSessionStore()
+    elif spec == 'memory':
+        return MemorySessionStore()
+    elif spec.startswith('sqlite:'):
+        return SQLiteSessionStore(spec[len('sqlite:'):])
+    raise ValueError("unknown session store '{0}'".format(spec))
+
+
+def session_store():
+    """Gets the SessionStore in use, opening it if necessary"""
+    global current
+    with current_lock:
+        if current == None:
+            current = open_store(SESSION_STORE or default_store())
+        return current
+
+
+def set_session_store(store):
+    """Replaces the SessionStore in use, e.g. with one opened by open_store"""
+    global current
+    with current_lock:
+        current = store
+
+
+class StoredSession(object):
+    """A user's login session as kept by the stores other than the
+    datastore, with the same fields as the datastore's Session"""
+    def __init__(self, token, trac_url, username, password, expiry):
+        self.token = token
+        self.trac_url = trac_url
+        self.username = username
+        self.password = password
+        self.expiry = expiry
+
+
+class SessionStore(object):
+    """Keeps login sessions by token, along with a pointer from each
+    url/username/password combo to its live session so logins can reuse it.
+    Sessions are objects with token, trac_url, username, password and
+    expiry (a datetime) attributes"""
+    def new_session(self, token, url, username, password, expiry):
+        """Creates (but doesn't store) a session"""
+        raise NotImplementedError("session stores need to implement this")
+
+    def login_session(self, url, username, password):
+        """Gets the live session for a url/username/password combo, or None"""
+        raise NotImplementedError("session stores need to implement this")
+
+    def session(self, token):
+        """Gets the live session for a token, or None"""
+        raise NotImplementedError("session stores need to implement this")
+
+    def put(self, session):
+        """Stores a session and points its url/username/password at it"""
+        raise NotImplementedError("session stores need to implement this")
+
+    def delete(self, session):
+        """Deletes a session, and the pointer to it from its
+        url/username/password if it still points at it"""
+        raise NotImplementedError("session stores need to implement this")
+
+    def sweep(self, batch_size, time_limit):
+        """Deletes expired sessions and pointers batch_size at a time,
+        stopping after time_limit seconds. Returns a tuple of a dict reporting
+        how many 'sessions' and 'logins' were deleted and whether the sweep was
+        'complete', and the tokens of the deleted sessions"""
+        raise NotImplementedError("session stores need to implement this")
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps sessions in this process's memory, for single process servers
+    and tests. Sessions are lost on restart"""
+    def __init__(self):
+        self._sessions = dict()
+        # login key name -> (token, expiry)
+        self._logins = dict()
+        self._lock = threading.Lock()
+
+    def new_session(self, token, url, username, password, expiry):
+        return StoredSession(token, url, username, password, expiry)
+
+    def login_session(self, url, username, password):
+        with self._lock:
+            login = self._logins.get(login_key_name(url, username, password))
+            if login == None or login[1] <= datetime.now():
+                return None
+            return self._sessions.get(login[0])
+
+    def session(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+        if session == None or session.expiry <= datetime.now():
+            return None
+        return session
+
+    def put(self, session):
+        with self._lock:
+            self._sessions[session.token] = session
+            self._logins[login_key_name(session.trac_url, session.username,
+                                        session.password)] = (session.token, session.expiry)
+
+    def delete(self, session):
+        name = login_key_name(session.trac_url, session.username, session.password)
+        with self._lock:
+            self._sessions.pop(session.token, None)
+            login = self._logins.get(name)
+            if login != None and login[0] == session.token:
+                del self._logins[name]
+
+    def sweep(self, batch_size, time_limit):
+        # everything is deleted under one lock, so batches don't matter
+        now = datetime.now()
+        with self._lock:
+            tokens = [token for token, session in self._sessions.items()
+                      if session.expiry < now]
+            for token in tokens:
+                del self._sessions[token]
+            names = [name for name, login in self._logins.items() if login[1] < now]
+            for name in names:
+                del self._logins[name]
+        return ({'sessions': len(tokens), 'logins': len(names), 'complete': True}, tokens)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Keeps sessions in a SQLite database file, so they survive restarts
+    and are shared by every worker process of a server on the same host.
+    Each thread uses its own connection"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "token TEXT PRIMARY KEY, trac_url TEXT NOT NULL, "
+                         "username TEXT NOT NULL, password TEXT NOT NULL, "
+                         "expiry TIMESTAMP NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+            conn.execute("CREATE TABLE IF NOT EXISTS logins ("
+                         "name TEXT PRIMARY KEY, token TEXT NOT NULL, "
+                         "expiry TIMESTAMP NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS logins_expiry ON logins (expiry)")
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn == None:
+            # only imported when needed since App Engine has no sqlite3
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT,
+                                   detect_types=sqlite3.PARSE_DECLTYPES)
+            self._local.conn = conn
+        return conn
+
+    def new_session(self, token, url, username, password, expiry):
+        return StoredSession(token, url, username, password, expiry)
+
+    def login_session(self, url, username, password):
+        row = self.connection().execute(
+            "SELECT s.token, s.trac_url, s.username, s.password, s.expiry "
+            "FROM logins l JOIN sessions s ON s.token = l.token "
+            "WHERE l.name = ? AND l.expiry > ?",
+            (login_key_name(url, username, password), datetime.now())).fetchone()
+        if row == None:
+            return None
+        return StoredSession(*row)
+
+    def session(self, token):
+        row = self.connection().execute(
+            "SELECT token, trac_url, username, password, expiry FROM sessions "
+            "WHERE token = ? AND expiry > ?", (token, datetime.now())).fetchone()
+        if row == None:
+            return None
+        return StoredSession(*row)
+
+    def put(self, session):
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                         (session.token, session.trac_url, session.username,
+                          session.password, session.expiry))
+            conn.execute("INSERT OR REPLACE INTO logins VALUES (?, ?, ?)",
+                         (login_key_name(session.trac_url, session.username,
+                                         session.password),
+                          session.token, session.expiry))
+
+    def delete(self, session):
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE token = ?", (session.token,))
+            conn.execute("DELETE FROM logins WHERE name = ? AND token = ?",
+                         (login_key_name(session.trac_url, session.username,
+                                         session.password),
+                          session.token))
+
+    def sweep(self, batch_size, time_limit):
+        started = time.time()
+        now = datetime.now()
+        conn = self.connection()
+        report = {'sessions': 0, 'logins': 0, 'complete': True}
+        tokens = []
+        for table, key, name in (('sessions', 'token', 'sessions'),
+                                 ('logins', 'name', 'logins')):
+            while True:
+                # each batch is its own transaction so other processes
+                # aren't locked out for the whole sweep
+                with conn:
+                    keys = [row[0] for row in conn.execute(
+                        "SELECT {0} FROM {1} WHERE expiry < ? LIMIT ?".format(key, table),
+                        (now, batch_size))]
+                    conn.executemany("DELETE FROM {0} WHERE {1} = ?".format(table, key),
+                                     [(k,) for k in keys])
+                report[name] += len(keys)
+                if table == 'sessions':
+                    tokens.extend(keys)
+                if len(keys) < batch_size:
+                    break
+                if time.time() - started > time_limit:
+                    report['complete'] = False
+                    break
+        return (report, tokens)
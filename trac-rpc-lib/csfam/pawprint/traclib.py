@@ -1,52 +1,176 @@
+from csfam.pawprint import stats
+from csfam.pawprint.cache import LRUCache, TieredCache, cache_key
+from csfam.pawprint.index import TicketIndex, later_changetime
+from csfam.pawprint.transport import server_proxy, pool_stats, flights, \
+    circuit_stats, is_upstream_failure, CircuitOpen, DeadlineExceeded, \
+    current_deadline, set_current_deadline, start_deadline, clear_deadline
+from csfam.pawprint.store import session_store
 from datetime import datetime, timedelta
-from google.appengine.ext import db
 from urlparse import urlunparse, urlparse
 from uuid import uuid4
-from xmlrpclib import ServerProxy
+import base64
+import bisect
+import calendar
+import hashlib
+import itertools
 import json
 import logging
+import sys
+import threading
+import time
 import xmlrpclib
 
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    # outside App Engine warm-ups run on a thread instead (see queue_warm_up)
+    taskqueue = None
+
 # token duration in seconds
 TOKEN_DURATION = 60*60*12
 
-# dict storing ServerProxy objects associated with a user's token/session 
-stored_proxies = dict()
+# number of expired sessions deleted per session store call by the sweeper
+SWEEP_BATCH_SIZE = 200
 
-class Session(db.Model):
-    """Models a user's login session with the following fields:
-        - token
-        - username
-        - password
-        - trac_url
-        - expiry
-    """
-    token = db.StringProperty(required=True)
-    trac_url = db.StringProperty(required=True)
-    username = db.StringProperty(required=True)
-    password = db.StringProperty(required=True)
-    expiry = db.DateTimeProperty(required=True)
+# seconds a sweep may run for, whatever is left is deleted by the next one
+SWEEP_TIME_LIMIT = 20
 
+# max number of ServerProxy objects kept by each instance
+PROXY_CACHE_SIZE = 2000
 
-def session_group_key(url):
-    """Constructs a datastore key for a SessionGroup
-    entity with the given url"""
-    return db.Key.from_path('SessionGroup', url)
+# ServerProxy objects associated with a user's token/session, each entry 
+# expires with its session and the least recently used are evicted first
+stored_proxies = LRUCache(PROXY_CACHE_SIZE)
+
+# max number of live sessions held in each instance's local cache
+SESSION_CACHE_SIZE = 5000
+
+# sessions keyed by token, each entry expires with its session
+session_cache = TieredCache('session', SESSION_CACHE_SIZE, TOKEN_DURATION)
+
+# protocol used to talk to Trac: 'xml', 'json' or 'auto' to use JSON-RPC
+# when the Trac server supports it and fall back to XML-RPC otherwise
+UPSTREAM_PROTOCOL = 'auto'
+
+# seconds a Trac's metadata lists (types, milestones, etc.) are cached for
+METADATA_TTL = 60*15
+
+# max number of metadata lists held in each instance's local cache
+METADATA_CACHE_SIZE = 1000
+
+# RPC methods returning the metadata lists shared by every user of a Trac
+METADATA_METHODS = ('ticket.type.getAll',
+                    'ticket.status.getAll',
+                    'ticket.version.getAll',
+                    'ticket.severity.getAll',
+                    'ticket.resolution.getAll',
+                    'ticket.priority.getAll',
+                    'ticket.milestone.getAll',
+                    'ticket.component.getAll')
+
+# (metadata list, ETag) tuples keyed by Trac url and RPC method name -- the
+# namespace changed when the ETags were added to the bare lists
+metadata_cache = TieredCache('metadata-etag', METADATA_CACHE_SIZE, METADATA_TTL)
+
+# the last metadata lists fetched from each Trac, kept past METADATA_TTL
+# so they can be served while the Trac is unavailable
+stale_metadata = LRUCache(METADATA_CACHE_SIZE)
+
+# number of ticket.get calls sent to Trac in each MultiCall
+MULTICALL_CHUNK_SIZE = 100
+
+# max number of MultiCall chunks in flight at once for one request, use 1
+# to fetch chunks one after another on runtimes that don't allow threads
+MULTICALL_WORKERS = 4
+
+# seconds a sync's high-water mark is moved back on top of the time its
+# tickets took to fetch, since changetimes only have second resolution
+SYNC_MARK_OVERLAP = 1
+
+# whether logins may ask for the new session's metadata lists and first
+# page of tickets to be fetched into the caches in the background
+WARM_AFTER_LOGIN = True
+
+# number of tickets on the first page warmed after a login, unless the
+# login asks for a different page size
+WARM_TICKET_PAGE_SIZE = 100
+
+# seconds a warmed page of tickets is kept waiting for its first request
+WARM_TICKET_TTL = 60*5
+
+# max number of warmed ticket pages held in each instance's local cache
+TICKET_PAGE_CACHE_SIZE = 200
+
+# pages of ticket structs keyed by Trac url, username and ticket query,
+# each is served once (see take_ticket_page)
+ticket_page_cache = TieredCache('ticket-page', TICKET_PAGE_CACHE_SIZE, WARM_TICKET_TTL)
+
+# number of tickets on each page of a cursor listing unless a max is given
+CURSOR_PAGE_SIZE = 100
+
+# seconds the sorted ticket ids of a query are kept for cursor listings to
+# page through, tickets created after the ids are fetched show up once
+# they're fetched again
+TICKET_IDS_TTL = 60
+
+# max number of ticket id lists held in each instance's local cache
+TICKET_IDS_CACHE_SIZE = 200
+
+# sorted ticket id lists keyed by Trac url, username and ticket query
+ticket_ids_cache = TieredCache('ticket-ids', TICKET_IDS_CACHE_SIZE, TICKET_IDS_TTL)
+
+# ticket fields the ticket index keeps an inverted index of, filters on
+# other fields have to look at every ticket
+TICKET_INDEX_FIELDS = ('status', 'owner', 'reporter', 'milestone', 'component',
+                       'type', 'priority', 'severity', 'version', 'resolution')
+
+# seconds between syncs of a ticket index with the tickets changed in Trac
+TICKET_INDEX_SYNC_INTERVAL = 30
+
+# seconds between full rebuilds of a ticket index, which drop tickets
+# deleted from Trac (syncing only picks up changed tickets)
+TICKET_INDEX_REBUILD_INTERVAL = 60*15
+
+# max number of tickets a project may have to be indexed, each index holds
+# the whole of every ticket so this bounds an instance's memory use
+TICKET_INDEX_MAX_TICKETS = 5000
+
+# max number of ticket indexes kept by each instance
+TICKET_INDEX_CACHE_SIZE = 10
+
+# TicketIndex objects keyed by Trac url and username
+ticket_indexes = LRUCache(TICKET_INDEX_CACHE_SIZE)
+ticket_indexes_lock = threading.Lock()
+
+stats.register('proxies', stored_proxies.stats)
+stats.register('session_cache', session_cache.stats)
+stats.register('metadata_cache', metadata_cache.stats)
+stats.register('ticket_page_cache', ticket_page_cache.stats)
+stats.register('ticket_indexes', ticket_indexes.stats)
+stats.register('ticket_ids_cache', ticket_ids_cache.stats)
+stats.register('connections', pool_stats)
+stats.register('coalescing', flights.stats)
+stats.register('circuits', circuit_stats)
+
+# max number of operations accepted in a single batch request
+MAX_BATCH_OPERATIONS = 100
+
+# batch operation names (matching the service urls) for the metadata lists
+BATCH_METADATA_OPERATIONS = {'ticket/meta/getTypes': 'ticket.type.getAll',
+                             'ticket/meta/getStates': 'ticket.status.getAll',
+                             'ticket/meta/getVersions': 'ticket.version.getAll',
+                             'ticket/meta/getSeverities': 'ticket.severity.getAll',
+                             'ticket/meta/getResolutions': 'ticket.resolution.getAll',
+                             'ticket/meta/getPriorities': 'ticket.priority.getAll',
+                             'milestone/getAll': 'ticket.milestone.getAll',
+                             'component/getAll': 'ticket.component.getAll'}
 
-    
 def user_session(url, username, password):
-    """Gets a Session object for a user/url combo from the
-    datastore or creates a new one if necessary.
+    """Gets a session for a user/url combo from the session
+    store or creates a new one if necessary.
     """
-    session = Session.gql("WHERE ANCESTOR IS :key "
-                           "AND username = :user "
-                           "AND password = :pw "
-                           "AND expiry > :ex "
-                           "ORDER BY expiry DESC",
-                           key=session_group_key(url),
-                           user=username,
-                           pw=password,
-                           ex=datetime.now()).get()
+    store = session_store()
+    session = store.login_session(url, username, password)
     
     if session == None:
         # if we don't have a valid session, authenticate 
@@ -54,14 +178,11 @@ def user_session(url, username, password):
         
         # a token should expire after a specified amount of time
         valid_duration = timedelta(seconds=TOKEN_DURATION)
+        token = str(uuid4())
+        expiry = datetime.now() + valid_duration
 
-        session = Session(parent=session_group_key(url),
-                          trac_url=url,
-                          username=username,
-                          password=password,
-                          token=str(uuid4()),
-                          expiry=(datetime.now() + valid_duration))
-        session.put()
+        session = store.new_session(token, url, username, password, expiry)
+        store.put(session)
         logging.debug("stored a new user session")
         
         # authenticate!
@@ -81,8 +202,43 @@ def user_session(url, username, password):
             session.token,
             session.expiry)
 
+    cache_session(session)
+    return session
+
+
+def session_for_token(token):
+    """Gets the live session for a token, checking the session cache
+    before the session store. Returns None if there's no live session"""
+    if not token:
+        return None
+    key = cache_key(token)
+    session = session_cache.get(key)
+    if session == None:
+        session = session_store().session(token)
+        if session != None:
+            cache_session(session)
+    elif seconds_until(session.expiry) <= 0:
+        session_cache.delete(key)
+        session = None
     return session
 
+##
+## Session caching & proxy code
+##
+
+def cache_session(session):
+    """Stores a session in the session cache until it expires"""
+    ttl = seconds_until(session.expiry)
+    if ttl > 0:
+        session_cache.put(cache_key(session.token), session, ttl)
+
+
+def seconds_until(when):
+    """Returns the number of whole seconds from now until the given
+    datetime, which is negative if it's already passed"""
+    remaining = when - datetime.now()
+    return remaining.days * 24*60*60 + remaining.seconds
+
 
 def authenticate(session):
     """Authenticates the user with the information provided in the
@@ -94,18 +250,36 @@ def authenticate(session):
 
 def cleanup_session(session):
     remove_proxy(session)
-    try:
-        session.delete()
-    except db.NotSavedError:
-        logging.error("tried removing a session that was not saved")
+    session_cache.delete(cache_key(session.token))
+    session_store().delete(session)
+
+
+def sweep_expired_sessions(batch_size=SWEEP_BATCH_SIZE, time_limit=SWEEP_TIME_LIMIT):
+    """Deletes expired sessions (and the logins pointing at them) from the
+    session store in batches of batch_size, stopping after time_limit
+    seconds, and drops expired proxies stored by this instance. Returns a
+    dict reporting how many of each were removed, how long it took and
+    whether the sweep finished"""
+    started = time.time()
+    report, tokens = session_store().sweep(batch_size, time_limit)
+    for token in tokens:
+        stored_proxies.delete(token)
+    report['proxies'] = stored_proxies.purge()
+    report['seconds'] = time.time() - started
+    logging.info("swept %(sessions)d sessions, %(logins)d logins and "
+                 "%(proxies)d proxies in %(seconds).2f seconds", report)
+    return report
 
 
 def proxy(session):
     """Gets a stored ServerProxy for this user session or
-    creates a new one, stores it in the dict, and returns it"""
+    creates a new one, stores it until the session expires, and returns it"""
     token = session.token
-    if stored_proxies.has_key(token):
-        return stored_proxies[token]
+    # ServerProxy turns comparison operators into RPC calls, so
+    # check the cached proxy by identity
+    p = stored_proxies.get(token)
+    if p is not None:
+        return p
     else:
         logging.debug("original url: %s", session.trac_url)
         url_parts = urlparse(session.trac_url)
@@ -121,29 +295,550 @@ def proxy(session):
                           url_parts.query,
                           url_parts.fragment))
         logging.debug("transformed url: %s", url)
-        p = ServerProxy(url, allow_none=True)
-        stored_proxies[session.token] = p
+        # connections are pooled per Trac host and shared by all sessions
+        p = server_proxy(url, UPSTREAM_PROTOCOL)
+        ttl = seconds_until(session.expiry)
+        if ttl > 0:
+            stored_proxies.put(token, p, ttl=ttl)
         return p
 
 
+def rpc_method(proxy, name):
+    """Resolves a dotted RPC method name (e.g. 'ticket.type.getAll')
+    against a ServerProxy or MultiCall object"""
+    method = proxy
+    for part in name.split('.'):
+        method = getattr(method, part)
+    return method
+
+
+def metadata_entry(session, proxy, method, refresh=False):
+    """Gets a tuple of the result of a metadata RPC method for the session's
+    Trac and its ETag, calling out to the server only if the result isn't
+    cached or a refresh is requested. The ETag is cached along with the
+    result so it doesn't need computing again"""
+    key = cache_key(session.trac_url, method)
+    if not refresh:
+        entry = metadata_cache.get(key)
+        if entry != None:
+            return entry
+    try:
+        result = rpc_method(proxy, method)()
+    except Exception as e:
+        error = sys.exc_info()
+        entry = stale_metadata.get(key)
+        if entry is None or not upstream_unavailable(e):
+            raise error[0], error[1], error[2]
+        logging.warning("serving stale %s for %s: %s", method, session.trac_url, e)
+        return entry
+    return cache_metadata(key, result)
+
+
+def cache_metadata(key, result):
+    """Caches a metadata list along with its ETag, returning the entry"""
+    entry = (result, make_etag(json.dumps(result)))
+    metadata_cache.put(key, entry)
+    stale_metadata.put(key, entry)
+    return entry
+
+
+def upstream_unavailable(error):
+    """Whether an error means the Trac server couldn't be reached in time
+    (or its circuit is open), so cached data should be served if possible"""
+    return isinstance(error, (CircuitOpen, DeadlineExceeded)) or is_upstream_failure(error)
+
+
 def remove_proxy(session):
     """Removes the ServerProxy stored for this session"""
+    if not stored_proxies.delete(session.token):
+        logging.error("tried deleting a ServerProxy that didn't exist")
+
+##
+## Ticket fetching code
+##
+
+def fetch_tickets(proxy, ticket_ids, chunk_size=MULTICALL_CHUNK_SIZE,
+                  workers=MULTICALL_WORKERS):
+    """Gets the tickets with the given ids, splitting the ticket.get calls
+    into MultiCalls of chunk_size tickets and running up to workers of them
+    at once. Returns a generator of the ticket.get results in the same order
+    as ticket_ids. Workers don't run more than workers chunks ahead of the
+    chunk being read, so a slow reader doesn't have every chunk pile up"""
+    chunks = [ticket_ids[i:i + chunk_size]
+              for i in range(0, len(ticket_ids), chunk_size)]
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for ticket in fetch_chunk(proxy, chunk):
+                yield ticket
+        return
+    
+    results = [None] * len(chunks)
+    done = [threading.Event() for chunk in chunks]
+    pending = range(len(chunks))
+    pending.reverse()
+    lock = threading.Lock()
+    state = {'cancelled': False}
+    # a slot per chunk fetched but not read yet
+    slots = threading.Semaphore(workers)
+    timer = stats.current_timer()
+    deadline = current_deadline()
+    
+    def work():
+        # count the worker's upstream time towards the request's and
+        # stop at the request's deadline
+        stats.set_current_timer(timer)
+        set_current_deadline(deadline)
+        while True:
+            slots.acquire()
+            with lock:
+                if state['cancelled'] or not pending:
+                    return
+                i = pending.pop()
+            try:
+                results[i] = (True, fetch_chunk(proxy, chunks[i]))
+            except Exception:
+                results[i] = (False, sys.exc_info())
+            done[i].set()
+    
+    for n in range(min(workers, len(chunks))):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+    
+    try:
+        for i in range(len(chunks)):
+            done[i].wait()
+            ok, value = results[i]
+            results[i] = None
+            if not ok:
+                raise value[0], value[1], value[2]
+            for ticket in value:
+                yield ticket
+            slots.release()
+    finally:
+        # stop the workers from picking up chunks nobody will read,
+        # waking those waiting on a slot
+        with lock:
+            state['cancelled'] = True
+        for n in range(workers):
+            slots.release()
+
+
+def sync_tickets(proxy, since):
+    """Gets the tickets changed since the given changetime string (in the
+    format tickets_to_struct produces). Returns a tuple of the list of ticket
+    structs and the high-water mark to pass as since on the next sync.
+    The mark overlaps the time the tickets took to fetch, so the next sync
+    may return some of the same tickets again"""
+    started = time.time()
+    ticket_ids = proxy.ticket.getRecentChanges(parse_changetime(since))
+    tickets = tickets_to_struct(fetch_tickets(proxy, ticket_ids))
+    mark = since
+    for ticket in tickets:
+        mark = later_changetime(mark, ticket)
+    return (tickets, max(since, overlap_mark(mark, started)))
+
+
+def overlap_mark(mark, started):
+    """Moves a high-water mark taken from tickets fetched since started
+    back by the time that took. A ticket changed after its id was listed
+    but before a ticket fetched later changed again would otherwise fall
+    behind the mark and never be synced"""
+    seconds = int(time.time() - started) + 1 + SYNC_MARK_OVERLAP
+    then = calendar.timegm(time.strptime(mark.rstrip('Z'), "%Y%m%dT%H:%M:%S"))
+    return time.strftime("%Y%m%dT%H:%M:%SZ", time.gmtime(then - seconds))
+
+
+def ticket_page_after(session, proxy, query, after, page_size):
+    """Gets a page of up to page_size (0 for no limit) ticket ids matching
+    the ticket query that come after the ticket id after, in id order.
+    Returns a tuple of the ids and the cursor for the next page, which is
+    None if this is the last page.
+    
+    Pages start after the last ticket of the previous one rather than at
+    an offset, so they don't shift when tickets are added or deleted. The
+    query's ids are cached so later pages don't run the query again"""
+    key = cache_key(session.trac_url, session.username, query)
+    ids = ticket_ids_cache.get(key)
+    if ids == None:
+        ids = proxy.ticket.query(query and 'max=0&' + query or 'max=0')
+        ids.sort()
+        ticket_ids_cache.put(key, ids)
+    start = bisect.bisect_right(ids, after)
+    if page_size:
+        page = ids[start:start + page_size]
+    else:
+        page = ids[start:]
+    if not page or start + len(page) >= len(ids):
+        return (page, None)
+    return (page, encode_cursor(query, page[-1], page_size))
+
+
+def encode_cursor(query, after, page_size):
+    """Builds the opaque cursor handed to clients for the next page of
+    a cursor listing"""
+    return base64.urlsafe_b64encode(json.dumps({'q': query, 'after': after,
+                                                'max': page_size}))
+
+
+def decode_cursor(value):
+    """Parses a cursor built by encode_cursor into a tuple of the ticket
+    query, the id to start after and the page size, raising an
+    InvalidParameterError if it's malformed"""
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(str(value)))
+        query, after, page_size = cursor['q'], cursor['after'], cursor['max']
+    except (TypeError, ValueError, KeyError):
+        raise InvalidParameterError('cursor', value)
+    if not isinstance(query, basestring) or not isinstance(after, int) or \
+            not isinstance(page_size, int) or page_size < 0:
+        raise InvalidParameterError('cursor', value)
+    return (query, after, page_size)
+
+
+def parse_changetime(value):
+    """Parses a changetime string such as '20110131T18:30:00Z' into an
+    xmlrpclib.DateTime, raising an InvalidParameterError if it's malformed"""
     try:
-        del stored_proxies[session.token]
-    except KeyError:
-        logging.exception("tried deleting a ServerProxy that didn't exist")
+        time.strptime(value.rstrip('Z'), "%Y%m%dT%H:%M:%S")
+    except ValueError:
+        raise InvalidParameterError('since', value)
+    return xmlrpclib.DateTime(str(value.rstrip('Z')))
+
+
+def fetch_chunk(proxy, ticket_ids):
+    """Gets a list of tickets with a single MultiCall, raising a Fault
+    if getting any of them failed"""
+    multicall = xmlrpclib.MultiCall(proxy)
+    for ticket_id in ticket_ids:
+        multicall.ticket.get(ticket_id)
+    return list(multicall())
+
+##
+## Ticket index code
+##
+
+def ticket_index(session, proxy, sync=False):
+    """Gets the ticket index of the session's Trac, building it if it
+    doesn't exist yet and bringing it up to date with the tickets changed
+    in Trac if it hasn't been synced for TICKET_INDEX_SYNC_INTERVAL seconds
+    (or sync is True). If Trac can't be reached, an index that has been
+    built before is returned as it is"""
+    # what a user can see depends on their permissions, so indexes
+    # aren't shared between users
+    key = cache_key(session.trac_url, session.username)
+    with ticket_indexes_lock:
+        index = ticket_indexes.get(key)
+        if index is None:
+            index = TicketIndex(TICKET_INDEX_FIELDS)
+            ticket_indexes.put(key, index)
+    
+    with index.lock:
+        now = time.time()
+        if index.built == None:
+            build_ticket_index(index, proxy)
+            return index
+        try:
+            if now - index.built > TICKET_INDEX_REBUILD_INTERVAL:
+                build_ticket_index(index, proxy)
+            elif sync or now - index.synced > TICKET_INDEX_SYNC_INTERVAL:
+                if index.mark:
+                    tickets, mark = sync_tickets(proxy, index.mark)
+                    index.update(tickets)
+                    index.mark = mark
+                    index.synced = now
+                else:
+                    # there's no changetime to sync from in an empty project
+                    build_ticket_index(index, proxy)
+        except Exception as e:
+            if not upstream_unavailable(e):
+                raise
+            logging.warning("serving a stale ticket index for %s: %s", session.trac_url, e)
+    return index
+
+
+def build_ticket_index(index, proxy):
+    """Fills an index with every ticket of the Trac, raising a
+    TooManyTicketsError if there are more than TICKET_INDEX_MAX_TICKETS.
+    Once refused, builds fail fast until TICKET_INDEX_REBUILD_INTERVAL
+    seconds have passed rather than listing every ticket again"""
+    started = time.time()
+    if index.refused != None and started - index.refused[0] < TICKET_INDEX_REBUILD_INTERVAL:
+        raise TooManyTicketsError(index.refused[1], TICKET_INDEX_MAX_TICKETS)
+    ticket_ids = proxy.ticket.query('max=0&order=id')
+    if len(ticket_ids) > TICKET_INDEX_MAX_TICKETS:
+        index.refused = (started, len(ticket_ids))
+        raise TooManyTicketsError(len(ticket_ids), TICKET_INDEX_MAX_TICKETS)
+    index.refused = None
+    index.replace(iter_tickets_to_struct(fetch_tickets(proxy, ticket_ids)))
+    if index.mark:
+        index.mark = overlap_mark(index.mark, started)
+    index.built = index.synced = started
+
+##
+## Batch request code
+##
+
+def batch_operation(op):
+    """Parses a single batch operation into a tuple of 
+    (RPC method name, params, result transform function). Raises
+    a TracError if the operation isn't valid"""
+    if not isinstance(op, dict):
+        raise InvalidParameterError('op', op)
+    name = op.get('op')
+    if name == None:
+        raise MissingRequiredParameterError('op')
+    elif BATCH_METADATA_OPERATIONS.has_key(name):
+        return (BATCH_METADATA_OPERATIONS[name], (), None)
+    elif name == 'ticket/query':
+        query = op.get('query')
+        if query == None:
+            return ('ticket.query', (), None)
+        return ('ticket.query', (query,), None)
+    elif name == 'ticket/get':
+        ticket_id = op.get('id')
+        if ticket_id == None:
+            raise MissingRequiredParameterError('id')
+        elif not isinstance(ticket_id, int):
+            raise InvalidParameterError('id', ticket_id)
+        return ('ticket.get', (ticket_id,), lambda t: tickets_to_struct([t])[0])
+    else:
+        raise UnknownOperationError(name)
+
+
+def run_batch(session, proxy, ops, refresh=False):
+    """Runs a list of batch operations for the session, folding all of the
+    upstream calls into a single MultiCall. Cached metadata lists are served
+    without calling Trac unless a refresh is requested.
+    
+    If Trac can't be reached, metadata lists fetched from it before are
+    served and the other operations get an error structure.
+    
+    Returns a list with a success or error structure for each operation"""
+    if len(ops) > MAX_BATCH_OPERATIONS:
+        raise InvalidParameterError('ops', "{0} operations".format(len(ops)))
+    
+    responses = [None] * len(ops)
+    multicall = xmlrpclib.MultiCall(proxy)
+    pending = []
+    for i, op in enumerate(ops):
+        try:
+            method, params, transform = batch_operation(op)
+        except TracError as te:
+            responses[i] = error_struct(te)
+            continue
+        
+        if method in METADATA_METHODS and not refresh:
+            entry = metadata_cache.get(cache_key(session.trac_url, method))
+            if entry != None:
+                responses[i] = success_struct(entry[0])
+                continue
+        
+        rpc_method(multicall, method)(*params)
+        pending.append((i, method, transform))
+    
+    if pending:
+        try:
+            results = multicall()
+        except Exception as e:
+            if not upstream_unavailable(e):
+                raise
+            # fall back to whatever stale data there is for each operation
+            err = upstream_error_to_trac_error(e, session.trac_url)
+            for i, method, transform in pending:
+                entry = None
+                if method in METADATA_METHODS:
+                    entry = stale_metadata.get(cache_key(session.trac_url, method))
+                if entry is not None:
+                    responses[i] = success_struct(entry[0])
+                else:
+                    responses[i] = error_struct(err)
+            return responses
+        
+        for n, (i, method, transform) in enumerate(pending):
+            try:
+                result = results[n]
+            except xmlrpclib.Fault as f:
+                responses[i] = error_struct(fault_error_to_trac_error(f))
+                continue
+            
+            if method in METADATA_METHODS:
+                cache_metadata(cache_key(session.trac_url, method), result)
+            if transform != None:
+                result = transform(result)
+            responses[i] = success_struct(result)
+    
+    return responses
+
+##
+## Post-login warm-up code
+##
+
+def queue_warm_up(session, page_size=WARM_TICKET_PAGE_SIZE):
+    """Adds a task warming the caches for a new session (see WarmSession),
+    or starts a thread doing it outside App Engine. Failing to queue it is
+    logged rather than raised, since the caches are only a head start"""
+    if taskqueue == None:
+        worker = threading.Thread(target=warm_in_background, args=(session, page_size))
+        worker.daemon = True
+        worker.start()
+        return
+    try:
+        taskqueue.add(url='/tasks/warmSession',
+                      params={'token': session.token, 'max': page_size})
+    except taskqueue.Error:
+        logging.exception("could not queue the warm-up for %s", session.trac_url)
+
+
+def warm_in_background(session, page_size):
+    start_deadline()
+    try:
+        warmed = warm_session(session, proxy(session), page_size)
+        logging.debug("warmed metadata and %d tickets for %s", warmed, session.trac_url)
+    except Exception:
+        logging.exception("could not warm session for %s", session.trac_url)
+    finally:
+        clear_deadline()
+
+
+def warm_session(session, proxy, page_size=WARM_TICKET_PAGE_SIZE):
+    """Fetches the metadata lists and the first page_size tickets for the
+    session into the caches, with a single MultiCall for the metadata lists
+    (that aren't already cached) and the page's ticket ids. A page_size of 0
+    only warms the metadata lists. Returns the number of tickets warmed"""
+    ops = [{'op': op} for op in sorted(BATCH_METADATA_OPERATIONS.keys())]
+    if page_size > 0:
+        query = ticket_page_query(page_size, 1)
+        ops.append({'op': 'ticket/query', 'query': query})
+    responses = run_batch(session, proxy, ops)
+    if page_size <= 0:
+        return 0
+    
+    response = responses[-1]
+    if not response['success']:
+        logging.warning("could not warm tickets for %s: %s",
+                        session.trac_url, response['reason']['errmsg'])
+        return 0
+    tickets = tickets_to_struct(fetch_tickets(proxy, response['result']))
+    ticket_page_cache.put(ticket_page_key(session, query), tickets)
+    return len(tickets)
+
+
+def ticket_page_query(page_size, page):
+    """Builds the ticket.query string for a page of tickets"""
+    return 'max={m}&page={p}'.format(m=page_size, p=page)
+
+
+def ticket_page_key(session, query):
+    # what a user can see depends on their permissions, so pages aren't
+    # shared between users
+    return cache_key(session.trac_url, session.username, query)
+
+
+def take_ticket_page(session, query):
+    """Gets the warmed ticket structs for the session's ticket query and
+    drops them from the cache, so only the first request after a login is
+    served from it. Returns None if the page wasn't warmed"""
+    key = ticket_page_key(session, query)
+    tickets = ticket_page_cache.get(key)
+    if tickets != None:
+        ticket_page_cache.delete(key)
+    return tickets
 
 ##
 ## Trac response writing & parsing code
 ##
 
+def success_struct(struct):
+    """Wraps a result in the standard success structure"""
+    return { "success" : True, "result" : struct }
+
+
 def generate_success_response(struct):
     """Generates a standard response structure:
     { "successs" : true,
       "result" : <object representing result>
     }
     """
-    return json.dumps({ "success" : True, "result" : struct })
+    with stats.phase('encode'):
+        return json.dumps(success_struct(struct))
+
+
+def make_etag(*parts):
+    """Builds a strong ETag header value from the given parts"""
+    return '"{0}"'.format(cache_key(*parts))
+
+
+def etag_matches(header, etag):
+    """Checks whether an If-None-Match header value matches an ETag"""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        # If-None-Match uses weak comparison
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+class TicketListTag(object):
+    """Builds the ETag of a ticket list out of its ticket ids and latest
+    changetime as the tickets stream past, so the list doesn't need to
+    be hashed (or kept) in full. The given parts (e.g. the requested
+    fields and format) are hashed in too"""
+    def __init__(self, *parts):
+        self._hash = hashlib.md5(cache_key(*parts))
+        self.changetime = ''
+    
+    def track(self, tickets):
+        """Generator passing on the ticket structs while tracking them"""
+        for ticket in tickets:
+            self._hash.update("{0},".format(ticket['id']))
+            self.changetime = later_changetime(self.changetime, ticket)
+            yield ticket
+    
+    def etag(self):
+        tag = self._hash.copy()
+        tag.update(self.changetime)
+        return '"{0}"'.format(tag.hexdigest())
+
+
+def write_success_response(out, items):
+    """Writes the standard response structure for a list result to out,
+    encoding and writing each item as it's produced by the items iterable
+    rather than building the whole response in memory first"""
+    out.write('{"success": true, "result": ')
+    write_json_list(out, items)
+    out.write('}')
+
+
+def write_columnar_response(out, fields, rows):
+    """Writes the standard response structure for a columnar result
+    (see tickets_to_columns) to out, encoding the rows one at a time"""
+    out.write('{"success": true, "result": {"fields": ')
+    out.write(json.dumps(fields))
+    out.write(', "rows": ')
+    write_json_list(out, rows)
+    out.write('}}')
+
+
+def write_json_list(out, items):
+    """Writes the items iterable to out as a JSON array"""
+    out.write('[')
+    first = True
+    encoding = 0.0
+    for item in items:
+        if not first:
+            out.write(', ')
+        started = time.time()
+        encoded = json.dumps(item)
+        encoding += time.time() - started
+        out.write(encoded)
+        first = False
+    out.write(']')
+    stats.add_phase('encode', encoding)
 
 
 def tickets_to_struct(tickets):
@@ -153,28 +848,70 @@ def tickets_to_struct(tickets):
     Requires that it is passed an interable, not a lone ticket object.
     If there's only one ticket, just wrap it in [ ]
     """
-    ticket_arr = []
+    return list(iter_tickets_to_struct(tickets))
+
+
+def iter_tickets_to_struct(tickets):
+    """Generator version of tickets_to_struct which transforms
+    each ticket as it is read from the tickets iterable"""
     for ticket in tickets:
+        started = time.time()
         # put the ticket id into the ticket attributes obj
         ticket[3]['id'] = ticket[0]
         ticket = ticket[3]
         # transform times to ISO 8601 
         ticket['time'] = "{time}Z".format(time=str(ticket['time']))
         ticket['changetime'] = "{time}Z".format(time=str(ticket['changetime']))
-        ticket_arr.append(ticket)
+        stats.add_phase('transform', time.time() - started)
+        yield ticket
+
+def parse_fields(value):
+    """Parses a comma separated list of ticket field names. The id field
+    is always included first. Returns None if no fields were given"""
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields:
+        return None
+    return ['id'] + [field for field in fields if field != 'id']
+
+
+def project_tickets(tickets, fields):
+    """Generator restricting each ticket struct to the given fields"""
+    for ticket in tickets:
+        yield dict((field, ticket.get(field)) for field in fields)
+
+
+def tickets_to_columns(tickets, fields=None):
+    """Splits ticket structs into a columnar structure so field names 
+    aren't repeated for every ticket. Returns a tuple of the field names
+    and a generator of rows, each a list of values in field name order.
     
-    return ticket_arr
+    If no fields are given, the fields of the first ticket are used"""
+    tickets = iter(tickets)
+    if fields == None:
+        try:
+            first = tickets.next()
+        except StopIteration:
+            return ([], iter([]))
+        fields = ['id'] + sorted(field for field in first if field != 'id')
+        tickets = itertools.chain([first], tickets)
+    rows = ([ticket.get(field) for field in fields] for ticket in tickets)
+    return (fields, rows)
 
 ##
 ## Error-related code
 ##
 
+def error_struct(err):
+    """Transforms a TracError into the standard failure structure"""
+    return {'success': False, 
+            'reason': {'errcode': err.code, 
+                       'errmsg' : err.msg }}
+
+
 def trac_error_to_response(err):
     """Transforms a TracError class into a client-understandable
     JSON string with error details"""
-    return json.dumps({'success': False, 
-                       'reason': {'errcode': err.code, 
-                                  'errmsg' : err.msg }})
+    return json.dumps(error_struct(err))
 
 
 def protocol_error_to_trac_error(pe):
@@ -190,6 +927,19 @@ def protocol_error_to_trac_error(pe):
     else:
         return TracError(msg = "unknown protocol error: {0}".format(str(pe)))
 
+def upstream_error_to_trac_error(err, url):
+    """Transforms an error raised because the Trac server at url is
+    unavailable (see upstream_unavailable) into the proper subclass
+    of TracError"""
+    if isinstance(err, CircuitOpen):
+        return ServerUnavailableError(url, err.retry_after)
+    elif isinstance(err, DeadlineExceeded):
+        return DeadlineExceededError(url)
+    elif isinstance(err, xmlrpclib.ProtocolError):
+        return protocol_error_to_trac_error(err)
+    else:
+        return ServerUnavailableError(url)
+
 def fault_error_to_trac_error(fault):
     """Transforms an xmlrpclib.Fault into proper subclass
     of TracError based on Fault.faultCode value. Fault types
@@ -248,6 +998,34 @@ class DoesNotSupportRPCError(TracError):
         TracError.__init__(self, 347, "the specified Trac server '{0}' does not support RPC".format(url))
 
 
+class InvalidParameterError(TracError):
+    def __init__(self, param_name, value):
+        TracError.__init__(self, 377, "invalid value for parameter '{0}': {1}".format(param_name, value))
+
+
+class UnknownOperationError(TracError):
+    def __init__(self, op):
+        TracError.__init__(self, 387, "unknown batch operation '{0}'".format(op))
+
+
+class ServerUnavailableError(TracError):
+    """Raised while a Trac server is failing, retry_after is the number
+    of seconds until it's tried again (if known)"""
+    def __init__(self, url, retry_after=None):
+        TracError.__init__(self, 397, "the Trac server '{0}' is unavailable".format(url))
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(TracError):
+    def __init__(self, url):
+        TracError.__init__(self, 407, "the Trac server '{0}' did not respond in time".format(url))
+
+
+class TooManyTicketsError(TracError):
+    def __init__(self, count, limit):
+        TracError.__init__(self, 417, "{0} tickets is more than the {1} that can be indexed".format(count, limit))
+
+
 ## Exceptions mapping to specific fault errors defined in xmlrpclib
 class TracFaultError(TracError):
     """General Fault error of which there are many subclasses"""
@@ -0,0 +1,620 @@
+from csfam.pawprint import stats
+from csfam.pawprint.flight import SingleFlight, WaitTimeout
+from xmlrpclib import Transport, ServerProxy, ProtocolError, ResponseError, Fault
+import base64
+import httplib
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+import urllib
+import xmlrpclib
+
+# max number of idle connections kept open to each Trac host
+POOL_SIZE = 8
+
+# seconds an idle connection is kept before it's closed instead of reused
+IDLE_TIMEOUT = 30
+
+# ConnectionPool objects keyed by (scheme, host)
+pools = dict()
+pools_lock = threading.Lock()
+
+# whether a Trac RPC url speaks JSON-RPC, keyed by (scheme, host, path)
+json_support = dict()
+
+# whether identical requests made at the same time by the same user to the
+# same Trac share one upstream call -- pawprint only makes read-only calls
+COALESCE_REQUESTS = True
+
+# upstream requests in flight keyed by url (including credentials) and body
+flights = SingleFlight()
+
+# max seconds a single call to Trac may wait on the network
+UPSTREAM_TIMEOUT = 10
+
+# max seconds all of the upstream calls made for one request may take,
+# which keeps requests well within the platform's request deadline
+REQUEST_DEADLINE = 25
+
+# min seconds a request's deadline can be shortened to
+MIN_REQUEST_DEADLINE = 1
+
+# consecutive failed calls to a Trac RPC url that open its circuit
+CIRCUIT_FAILURE_THRESHOLD = 5
+
+# seconds an open circuit fails calls fast before letting a trial call
+# through to see whether the server has recovered
+CIRCUIT_RESET_TIMEOUT = 30
+
+# the deadline of the request being handled by the current thread
+current = threading.local()
+
+# CircuitBreaker objects keyed by (scheme, host, path)
+breakers = dict()
+breakers_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTP/1.1 connections to a single host so that requests
+    from every session using that host can reuse them instead of paying
+    for a new TCP (and TLS) connection each time"""
+    def __init__(self, scheme, host, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns a tuple of (connection, reused) where reused is True
+        if the connection came from the idle pool"""
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, idle_since = self._idle.pop()
+                if now - idle_since < self.idle_timeout:
+                    self.reused += 1
+                    return (conn, True)
+                conn.close()
+                self.discarded += 1
+        return (self.connect(), False)
+
+    def connect(self):
+        """Opens a new connection to the pool's host"""
+        with self._lock:
+            self.created += 1
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host)
+        return httplib.HTTPConnection(self.host)
+
+    def release(self, conn):
+        """Puts a connection whose response has been fully read back
+        into the pool, closing it if the pool is full"""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+            self.discarded += 1
+        conn.close()
+
+    def discard(self, conn):
+        """Closes a connection that can't be reused"""
+        with self._lock:
+            self.discarded += 1
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle),
+                    'created': self.created,
+                    'reused': self.reused,
+                    'discarded': self.discarded}
+
+
+def connection_pool(scheme, host):
+    """Gets the shared ConnectionPool for a host, creating it if necessary"""
+    with pools_lock:
+        pool = pools.get((scheme, host))
+        if pool == None:
+            pool = ConnectionPool(scheme, host)
+            pools[(scheme, host)] = pool
+        return pool
+
+
+def pool_stats():
+    """Returns the connection counters of every pool keyed by 'scheme://host'"""
+    with pools_lock:
+        items = pools.items()
+    stats = dict()
+    for (scheme, host), pool in items:
+        stats["{0}://{1}".format(scheme, host)] = pool.stats()
+    return stats
+
+
+##
+## Deadlines & circuit breaking
+##
+
+class DeadlineExceeded(Exception):
+    """Raised when a call to Trac would run past the request's deadline.
+    That says nothing about the server's health, unlike an UpstreamTimeout"""
+    def __init__(self, url):
+        Exception.__init__(self, "deadline exceeded calling {0}".format(url))
+        self.url = url
+
+
+class UpstreamTimeout(DeadlineExceeded):
+    """Raised when a call to Trac timed out after waiting the full
+    UPSTREAM_TIMEOUT on the server"""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a Trac RPC url that has been failing"""
+    def __init__(self, url, retry_after):
+        Exception.__init__(self, "circuit open for {0}".format(url))
+        self.url = url
+        self.retry_after = retry_after
+
+
+def start_deadline(seconds=None):
+    """Starts the deadline for the upstream calls made by the current
+    thread's request, seconds defaults to (and is capped at) REQUEST_DEADLINE
+    and can't be less than MIN_REQUEST_DEADLINE"""
+    if seconds == None or seconds > REQUEST_DEADLINE:
+        seconds = REQUEST_DEADLINE
+    seconds = max(seconds, MIN_REQUEST_DEADLINE)
+    current.deadline = time.time() + seconds
+    return current.deadline
+
+
+def clear_deadline():
+    current.deadline = None
+
+
+def current_deadline():
+    return getattr(current, 'deadline', None)
+
+
+def set_current_deadline(deadline):
+    """Lets worker threads honour the deadline of the request they work for"""
+    current.deadline = deadline
+
+
+def call_timeout(url):
+    """Gets the seconds the next upstream call may take, raising a
+    DeadlineExceeded if the request's deadline has already passed"""
+    deadline = current_deadline()
+    if deadline == None:
+        return UPSTREAM_TIMEOUT
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded(url)
+    return min(UPSTREAM_TIMEOUT, remaining)
+
+
+def timeout_error(url, timeout):
+    """Gets the error to raise for a call that timed out after timeout
+    seconds: the server's fault if it had the full UPSTREAM_TIMEOUT,
+    otherwise the request's deadline ran out first"""
+    if timeout >= UPSTREAM_TIMEOUT:
+        return UpstreamTimeout(url)
+    return DeadlineExceeded(url)
+
+
+def shares_error(error):
+    """Whether the error a coalesced call failed with applies to everyone
+    waiting on it, which it doesn't when only the deadline of the request
+    that made the call ran out"""
+    return not isinstance(error, DeadlineExceeded) or isinstance(error, UpstreamTimeout)
+
+
+def is_upstream_failure(error):
+    """Whether an error raised calling Trac means the server is unhealthy,
+    as opposed to a fault, a client error like bad credentials or the
+    request running out of time (a DeadlineExceeded)"""
+    if isinstance(error, ProtocolError):
+        return error.errcode >= 500
+    return isinstance(error, (UpstreamTimeout, socket.error, httplib.HTTPException))
+
+
+class CircuitBreaker(object):
+    """Tracks the health of a Trac RPC url. After threshold consecutive
+    failures the circuit opens and calls fail fast for reset_timeout
+    seconds, then a single trial call is let through: if it succeeds the
+    circuit closes, otherwise it opens again"""
+    def __init__(self, url, threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.url = url
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises a CircuitOpen if the call shouldn't be made"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + self.reset_timeout - time.time()
+            if self.state == 'open' and retry_after <= 0:
+                # let this call through as the trial
+                self.state = 'half-open'
+                return
+            self.rejected += 1
+        raise CircuitOpen(self.url, max(retry_after, 0))
+
+    def succeeded(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info("circuit for %s closed", self.url)
+            self.state = 'closed'
+            self.failures = 0
+
+    def inconclusive(self):
+        """Records a call that ended before learning anything about the
+        server's health, which hands the trial (if it was one) to the next call"""
+        with self._lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.opened += 1
+                    logging.warning("circuit for %s opened after %d failures",
+                                    self.url, self.failures)
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state,
+                    'failures': self.failures,
+                    'opened': self.opened,
+                    'rejected': self.rejected}
+
+
+def circuit_breaker(scheme, host, handler):
+    """Gets the shared CircuitBreaker for a Trac RPC url, creating it if
+    necessary. host must not include the user's credentials"""
+    key = (scheme, host, handler)
+    with breakers_lock:
+        breaker = breakers.get(key)
+        if breaker == None:
+            breaker = CircuitBreaker("{0}://{1}{2}".format(scheme, host, handler))
+            breakers[key] = breaker
+        return breaker
+
+
+def circuit_stats():
+    """Returns the state of every circuit keyed by url"""
+    with breakers_lock:
+        items = breakers.values()
+    return dict((breaker.url, breaker.stats()) for breaker in items)
+
+##
+## Pooled XML-RPC transport
+##
+
+class PooledTransport(Transport):
+    """An xmlrpclib Transport that sends requests over keep-alive
+    connections taken from the pool for the request's host. Credentials
+    are sent per request, so one pool serves every user of a Trac"""
+    scheme = 'http'
+    content_type = 'text/xml'
+
+    def request(self, host, handler, request_body, verbose=0):
+        with stats.phase('upstream'):
+            if not COALESCE_REQUESTS:
+                return self.guarded_request(host, handler, request_body)
+            # host includes the user's credentials, so calls are only shared
+            # between requests with the same permissions
+            key = (self.scheme, host, handler, self.content_type, request_body)
+            # waiters give up when their own deadline passes
+            deadline = current_deadline()
+            wait = None
+            if deadline != None:
+                wait = max(deadline - time.time(), 0)
+            try:
+                return flights.do(key, lambda: self.guarded_request(host, handler, request_body),
+                                  timeout=wait, share_error=shares_error)
+            except WaitTimeout:
+                raise DeadlineExceeded(self.get_host_info(host)[0] + handler)
+
+    def guarded_request(self, host, handler, request_body):
+        """Makes the request unless the url's circuit is open, counting
+        it towards the url's health"""
+        auth, chost = urllib.splituser(host)
+        breaker = circuit_breaker(self.scheme, chost, handler)
+        breaker.before_call()
+        try:
+            result = self.pooled_request(host, handler, request_body)
+        except Exception as e:
+            error = sys.exc_info()
+            if is_upstream_failure(e):
+                breaker.failed()
+            elif isinstance(e, DeadlineExceeded):
+                breaker.inconclusive()
+            else:
+                # the server answered, even if it was with an error
+                breaker.succeeded()
+            raise error[0], error[1], error[2]
+        breaker.succeeded()
+        return result
+
+    def pooled_request(self, host, handler, request_body):
+        chost, extra_headers, x509 = self.get_host_info(host)
+        url = chost + handler
+        timeout = call_timeout(url)
+        pool = connection_pool(self.scheme, chost)
+        conn, reused = pool.acquire()
+        try:
+            response = self.send_request_on(conn, chost, handler, request_body,
+                                            extra_headers, timeout)
+        except socket.timeout:
+            pool.discard(conn)
+            raise timeout_error(url, timeout)
+        except (socket.error, httplib.HTTPException):
+            pool.discard(conn)
+            if not reused:
+                raise
+            # the server may have closed an idle connection, try again
+            # once with a fresh one
+            logging.debug("retrying request to %s on a new connection", chost)
+            conn = pool.connect()
+            timeout = call_timeout(url)
+            try:
+                response = self.send_request_on(conn, chost, handler, request_body,
+                                                extra_headers, timeout)
+            except socket.timeout:
+                pool.discard(conn)
+                raise timeout_error(url, timeout)
+            except (socket.error, httplib.HTTPException):
+                pool.discard(conn)
+                raise
+
+        try:
+            data = response.read()
+        except socket.timeout:
+            pool.discard(conn)
+            raise timeout_error(url, timeout)
+        except (socket.error, httplib.HTTPException):
+            pool.discard(conn)
+            raise
+        if response.status != 200:
+            # don't trust the connection's state after an error response
+            pool.discard(conn)
+            raise self.response_error(host, handler, response, data)
+        elif response.will_close:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
+
+        return self.parse_response_data(response, data)
+
+    def send_request_on(self, conn, host, handler, request_body, extra_headers,
+                        timeout=None):
+        """Sends a request over conn and returns the response, waiting at
+        most timeout seconds on each of the connection's socket operations"""
+        if timeout != None:
+            # used when connecting, an already open socket needs it set
+            conn.timeout = timeout
+            if conn.sock != None:
+                conn.sock.settimeout(timeout)
+        conn.putrequest('POST', handler)
+        conn.putheader('User-Agent', self.user_agent)
+        conn.putheader('Content-Type', self.content_type)
+        conn.putheader('Content-Length', str(len(request_body)))
+        for key, value in extra_headers or ():
+            conn.putheader(key, value)
+        # send the body in the same write as the headers, otherwise Nagle's
+        # algorithm holds it back until the server's delayed ACK on a
+        # reused connection, adding ~40ms to every call
+        conn.endheaders(request_body)
+        return conn.getresponse()
+
+    def response_error(self, host, handler, response, data):
+        """Returns the error to raise for a non-200 response"""
+        # use the host with the auth info so errors can report the user
+        return ProtocolError(host + handler, response.status,
+                             response.reason, response.msg)
+
+    def parse_response_data(self, response, data):
+        """Unmarshals the body of a successful response"""
+        p, u = self.getparser()
+        p.feed(data)
+        p.close()
+        return u.close()
+
+
+class PooledSafeTransport(PooledTransport):
+    """PooledTransport for https Trac urls"""
+    scheme = 'https'
+
+
+def pooled_transport(scheme):
+    """Gets a transport for the given url scheme"""
+    if scheme == 'https':
+        return PooledSafeTransport(use_datetime=0)
+    return PooledTransport(use_datetime=0)
+
+##
+## JSON-RPC code
+##
+
+class JsonRpcTransport(PooledTransport):
+    """Sends JSON-RPC requests over the same pooled connections used for
+    XML-RPC, returning the decoded JSON response objects"""
+    content_type = 'application/json'
+
+    def response_error(self, host, handler, response, data):
+        # Trac may describe the error in a JSON-RPC error object
+        try:
+            error = self.parse_response_data(response, data).get('error')
+        except (ResponseError, AttributeError):
+            error = None
+        if error:
+            return json_fault(error)
+        return PooledTransport.response_error(self, host, handler, response, data)
+
+    def parse_response_data(self, response, data):
+        content_type = response.getheader('content-type') or ''
+        if not content_type.startswith('application/json'):
+            raise ResponseError("expected a JSON-RPC response, got '{0}'".format(content_type))
+        try:
+            return json.loads(data, object_hook=decode_jsonclass)
+        except ValueError:
+            raise ResponseError("badly formed JSON-RPC response")
+
+
+class JsonRpcSafeTransport(JsonRpcTransport):
+    """JsonRpcTransport for https Trac urls"""
+    scheme = 'https'
+
+
+def json_transport(scheme):
+    """Gets a JSON-RPC transport for the given url scheme"""
+    if scheme == 'https':
+        return JsonRpcSafeTransport(use_datetime=0)
+    return JsonRpcTransport(use_datetime=0)
+
+
+class JsonRpcProxy(object):
+    """Stands in for an xmlrpclib.ServerProxy, calling methods with Trac's
+    JSON-RPC protocol instead. It can be used with xmlrpclib.MultiCall, which
+    is sent as Trac's JSON version of system.multicall. Errors are raised as
+    the same Fault and ProtocolError exceptions ServerProxy raises"""
+    def __init__(self, uri, transport):
+        scheme, uri = urllib.splittype(uri)
+        self._host, self._handler = urllib.splithost(uri)
+        self._transport = transport
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return xmlrpclib._Method(self._request, name)
+
+    def _request(self, method, params):
+        if method == 'system.multicall':
+            return self._multicall(params[0])
+        return json_result(self._send(method, list(params)))
+
+    def _multicall(self, calls):
+        params = []
+        for n, call in enumerate(calls):
+            params.append({'method': call['methodName'],
+                           'params': call['params'],
+                           'id': n})
+        results = []
+        # put each result in the form xmlrpclib.MultiCall expects
+        for result in json_result(self._send('system.multicall', params)):
+            if result.get('error'):
+                error = result['error']
+                results.append({'faultCode': error.get('code'),
+                                'faultString': error.get('message')})
+            else:
+                results.append([result.get('result')])
+        return results
+
+    def _send(self, method, params):
+        # each request gets its own response on its connection, so the id can
+        # stay the same, which keeps identical calls' bodies identical too
+        body = json.dumps({'method': method, 'params': params, 'id': 1},
+                          default=encode_jsonclass)
+        return self._transport.request(self._host, self._handler, body)
+
+
+def json_result(response):
+    """Gets the result from a JSON-RPC response object, raising a 
+    Fault if the response holds an error"""
+    if response.get('error'):
+        raise json_fault(response['error'])
+    return response.get('result')
+
+
+def json_fault(error):
+    """Transforms a JSON-RPC error object into an xmlrpclib.Fault -- the
+    standard JSON-RPC error codes match the ones defined in xmlrpclib"""
+    return Fault(error.get('code'), error.get('message'))
+
+
+def encode_jsonclass(obj):
+    """Encodes XML-RPC values that JSON lacks the way Trac expects them"""
+    if isinstance(obj, xmlrpclib.DateTime):
+        value = obj.value
+        return {'__jsonclass__': ['datetime', "{0}-{1}-{2}{3}".format(value[0:4],
+                                                                      value[4:6],
+                                                                      value[6:8],
+                                                                      value[8:])]}
+    elif isinstance(obj, xmlrpclib.Binary):
+        return {'__jsonclass__': ['binary', base64.b64encode(obj.data)]}
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def decode_jsonclass(obj):
+    """Decodes Trac's JSON encoding of dates and binary data into the 
+    same xmlrpclib types an XML-RPC response would contain"""
+    jsonclass = obj.get('__jsonclass__')
+    if jsonclass and jsonclass[0] == 'datetime':
+        # '2011-01-31T18:30:00' -> '20110131T18:30:00'
+        return xmlrpclib.DateTime(str(jsonclass[1][:19].replace('-', '')))
+    elif jsonclass and jsonclass[0] == 'binary':
+        return xmlrpclib.Binary(base64.b64decode(jsonclass[1]))
+    return obj
+
+##
+## Protocol negotiation
+##
+
+def server_proxy(url, protocol='auto'):
+    """Gets a proxy for a Trac RPC url. The protocol can be 'xml' or 'json',
+    or 'auto' to use JSON-RPC when the server supports it"""
+    scheme, uri = urllib.splittype(url)
+    if protocol == 'json' or (protocol == 'auto' and supports_json(url)):
+        return JsonRpcProxy(url, json_transport(scheme))
+    return ServerProxy(url, transport=pooled_transport(scheme), allow_none=True)
+
+
+def supports_json(url):
+    """Checks, once per Trac RPC url, whether the server answers JSON-RPC.
+    Errors that don't tell us anything about the protocol (bad credentials,
+    unreachable server) aren't remembered"""
+    scheme, uri = urllib.splittype(url)
+    host, handler = urllib.splithost(uri)
+    auth, chost = urllib.splituser(host)
+    key = (scheme, chost, handler)
+    if json_support.has_key(key):
+        return json_support[key]
+
+    try:
+        JsonRpcProxy(url, json_transport(scheme)).system.getAPIVersion()
+        supported = True
+    except Fault:
+        # the server understood the JSON-RPC request
+        supported = True
+    except ProtocolError as pe:
+        if pe.errcode in (401, 403, 404):
+            return False
+        supported = False
+    except ResponseError:
+        supported = False
+    except (socket.error, httplib.HTTPException, DeadlineExceeded):
+        return False
+
+    json_support[key] = supported
+    logging.info("%s://%s%s %s JSON-RPC", scheme, chost, handler,
+                 supported and "supports" or "does not support")
+    return supported
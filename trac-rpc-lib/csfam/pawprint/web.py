@@ -0,0 +1,149 @@
+"""The parts of App Engine's webapp framework the pawprint handlers use,
+written against plain WSGI so the handlers can run outside App Engine
+(see wsgi.py). Only what the handlers need is here: request parameters
+and headers, a buffered response, and dispatching on url patterns.
+"""
+from StringIO import StringIO
+from wsgiref.headers import Headers
+import BaseHTTPServer
+import logging
+import re
+import sys
+import traceback
+import urlparse
+
+# reason phrases keyed by HTTP status code
+STATUS_MESSAGES = dict((code, messages[0])
+                       for code, messages in BaseHTTPServer.BaseHTTPRequestHandler.responses.items())
+
+
+class RequestHeaders(object):
+    """Case-insensitive, read-only access to the request's HTTP headers"""
+    def __init__(self, environ):
+        self._headers = dict()
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                self._headers[key[5:].replace('_', '-').lower()] = value
+        for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if environ.get(key):
+                self._headers[key.replace('_', '-').lower()] = environ[key]
+
+    def get(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return self._headers[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self._headers
+
+
+class Request(object):
+    """The request's path, headers and parameters, which are read from
+    both the query string and a form encoded body"""
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ['REQUEST_METHOD']
+        self.path = environ.get('PATH_INFO') or '/'
+        self.headers = RequestHeaders(environ)
+        self.params = dict()
+        self._parse(environ.get('QUERY_STRING', ''))
+        if self.method == 'POST' and (environ.get('CONTENT_TYPE') or '').startswith(
+                'application/x-www-form-urlencoded'):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            self._parse(environ['wsgi.input'].read(length))
+
+    def _parse(self, data):
+        for name, values in urlparse.parse_qs(data, keep_blank_values=True).items():
+            self.params.setdefault(name, []).extend([value.decode('utf-8', 'replace')
+                                                     for value in values])
+
+    def get(self, name, default_value=''):
+        """Gets the first value of a parameter, or default_value"""
+        values = self.params.get(name)
+        if not values:
+            return default_value
+        return values[0]
+
+    def get_all(self, name):
+        return self.params.get(name, [])
+
+    def arguments(self):
+        """Gets the names of the request's parameters"""
+        return self.params.keys()
+
+
+class Response(object):
+    """A buffered response, written out once the handler is done"""
+    def __init__(self):
+        self.out = StringIO()
+        self.headers = Headers([('Content-Type', 'text/html; charset=utf-8')])
+        self.status = 200
+        self.status_message = STATUS_MESSAGES[200]
+
+    def set_status(self, code, message=None):
+        self.status = code
+        self.status_message = message or STATUS_MESSAGES.get(code, '')
+
+    def clear(self):
+        """Drops everything written to the response so far"""
+        self.out.seek(0)
+        self.out.truncate(0)
+
+    def wsgi_write(self, start_response):
+        body = self.out.getvalue()
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if self.status == 304:
+            body = ''
+        self.headers['Content-Length'] = str(len(body))
+        start_response("{0} {1}".format(self.status, self.status_message),
+                       self.headers.items())
+        return [body]
+
+
+class RequestHandler(object):
+    """Base class of the handlers, subclasses implement get and/or post"""
+    def initialize(self, request, response):
+        self.request = request
+        self.response = response
+
+    def error(self, code):
+        self.response.set_status(code)
+        self.response.clear()
+
+
+class WSGIApplication(object):
+    """Dispatches requests to the handler whose url pattern matches the
+    whole of the request's path, calling its get or post method"""
+    def __init__(self, url_mapping, debug=False):
+        self.debug = debug
+        self.handlers = [(re.compile('^{0}$'.format(pattern)), handler)
+                         for pattern, handler in url_mapping]
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        response = Response()
+        for pattern, handler_class in self.handlers:
+            if pattern.match(request.path):
+                break
+        else:
+            response.set_status(404)
+            return response.wsgi_write(start_response)
+
+        handler = handler_class()
+        handler.initialize(request, response)
+        method = getattr(handler, request.method.lower(), None)
+        if method == None:
+            response.set_status(405)
+            return response.wsgi_write(start_response)
+        try:
+            method()
+        except Exception:
+            logging.exception("error handling %s", request.path)
+            response.clear()
+            response.set_status(500)
+            if self.debug:
+                response.headers['Content-Type'] = 'text/plain'
+                response.out.write(''.join(traceback.format_exception(*sys.exc_info())))
+        return response.wsgi_write(start_response)
@@ -0,0 +1,85 @@
+"""Serves pawprint as a plain WSGI application, for running it outside App
+Engine (see web.py). Without App Engine's services memcache is skipped and
+sessions are kept by store.py's SESSION_STORE.
+
+Every worker process has its own caches, so to spread the service across
+a host's cores run it under a multi-worker WSGI server with the sessions
+in SQLite, where every worker can find them:
+
+    PAWPRINT_SESSION_STORE=sqlite:/var/lib/pawprint/sessions.db \\
+        gunicorn --workers 4 --threads 8 csfam.pawprint.wsgi:application
+
+or, for development, with the threaded server in this module:
+
+    python -m csfam.pawprint.wsgi --port 8080
+
+The admin urls (/stats and /tasks/*, see routes.py) are only served to
+requests sending the PAWPRINT_ADMIN_KEY environment variable's value in
+an X-Admin-Key header, and are refused when it isn't set. Run the session
+sweep from cron with e.g.
+
+    curl -H "X-Admin-Key: $PAWPRINT_ADMIN_KEY" http://localhost:8080/tasks/sweepSessions
+"""
+from csfam.pawprint import store
+from csfam.pawprint.handlers import MigrateSessions
+from csfam.pawprint.routes import ROUTES, ADMIN_URLS
+from csfam.pawprint.web import WSGIApplication
+from optparse import OptionParser
+from wsgiref.simple_server import make_server, WSGIServer
+import SocketServer
+import os
+import re
+import sys
+
+# the key admin requests must send in an X-Admin-Key header
+ADMIN_KEY = os.environ.get('PAWPRINT_ADMIN_KEY')
+
+
+class AdminOnly(object):
+    """WSGI middleware refusing requests for the admin urls that
+    don't carry the admin key"""
+    def __init__(self, application, key, urls=ADMIN_URLS):
+        self.application = application
+        self.key = key
+        self.pattern = re.compile('^(?:{0})$'.format('|'.join(urls)))
+
+    def __call__(self, environ, start_response):
+        if (self.pattern.match(environ.get('PATH_INFO') or '/')
+                and (not self.key or environ.get('HTTP_X_ADMIN_KEY') != self.key)):
+            body = 'admin key required'
+            start_response('403 Forbidden', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', str(len(body)))])
+            return [body]
+        return self.application(environ, start_response)
+
+
+# migrating legacy sessions is only needed (and possible) in the datastore
+application = AdminOnly(WSGIApplication([route for route in ROUTES
+                                          if route[1] != MigrateSessions]),
+                        ADMIN_KEY)
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--host', default='127.0.0.1',
+                      help="interface to listen on (default %default)")
+    parser.add_option('--port', type='int', default=8080,
+                      help="port to listen on (default %default)")
+    parser.add_option('--store', default=None,
+                      help="session store, 'memory' or 'sqlite:<path>' "
+                           "(default $PAWPRINT_SESSION_STORE or memory)")
+    options, _ = parser.parse_args(argv)
+    if options.store:
+        store.set_session_store(store.open_store(options.store))
+
+    server = make_server(options.host, options.port, application,
+                         server_class=ThreadingWSGIServer)
+    print "serving on http://{0}:{1}/".format(options.host, options.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])